@@ -0,0 +1,46 @@
+import argparse
+import boto3
+import numpy as np
+import time
+from typing import Callable, Dict
+
+from TestBot.pricing import PricingModel
+
+# Rows per call: a single bet, a settlement group and a whole-match win-probability curve
+BATCH_SIZES = (1, 8, 60)
+
+def feature_rows(n: int, rng: np.random.Generator) -> np.array:
+    # Synthetic rows in the `features` layout: time and the ten hero ids, then time and xp, last hits
+    # and gold for the five radiant and five dire players
+    minutes = rng.integers(0, 60, n)
+    stats = lambda high: rng.integers(0, high, (n, 5)) * minutes[:, None]
+    return np.concatenate([(minutes * 60)[:, None], rng.integers(1, 130, (n, 10)), (minutes * 60)[:, None],
+                           stats(1000), stats(10), stats(700), stats(1000), stats(10), stats(700)], axis=1).astype(np.float32)
+
+def time_calls(fns: Dict[str, Callable], X: np.array, calls: int) -> Dict[str, Dict[str, float]]:
+    # Calls alternate between the paths so both see the same machine load
+    latencies = {name: [] for name in fns}
+    for ix in range(calls + 50):
+        for name, fn in fns.items():
+            start = time.perf_counter()
+            fn(X)
+            if ix >= 50:
+                latencies[name].append(time.perf_counter() - start)
+    return {name: {"p50": np.percentile(np.array(values) * 1e6, 50), "p99": np.percentile(np.array(values) * 1e6, 99)}
+            for name, values in latencies.items()}
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Per-call latency of PricingModel predictions, wrapper vs raw booster")
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    pricing = PricingModel(boto3.resource("s3"))
+    rng = np.random.default_rng(0)
+    print(f"{'rows':>5} {'predict_proba p50/p99 (us)':>28} {'booster p50/p99 (us)':>22} {'speedup':>8} {'max diff':>9}")
+    for rows in BATCH_SIZES:
+        X = feature_rows(rows, rng)
+        diff = np.max(np.abs(pricing._predict_sklearn(X) - pricing._predict_booster(X)))
+        timings = time_calls({"sklearn": pricing._predict_sklearn, "booster": pricing._predict_booster}, X, args.calls)
+        sklearn, booster = timings["sklearn"], timings["booster"]
+        print(f"{rows:>5} {sklearn['p50']:>16.1f} / {sklearn['p99']:<9.1f} {booster['p50']:>10.1f} / {booster['p99']:<9.1f}"
+              f" {sklearn['p50'] / booster['p50']:>7.1f}x {diff:>9.2e}")
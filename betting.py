@@ -5,30 +5,43 @@ from botocore.config import Config
 import disnake
 from decimal import Decimal
 from fuzzywuzzy import process, fuzz
+import functools
 import logging
 import os
 import time
 import multiprocessing
-import threading
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
 import traceback
 
 from TestBot.database.dynamo import DynamoHandler, Action
+from TestBot.dispatcher import BetDispatcher, DEFAULT_CONCURRENCY
+from TestBot.journal import BetJournal, JournalEntry, QUEUED, DEBITED, WATCHING, PARSING, SETTLED
 from TestBot.pricing import PricingModel
-from TestBot.opendota.client import SyncDotaClient, AsyncDotaClient
-from TestBot.utils import LogMessage
-from TestBot.exceptions import BalanceException, LobbyTypeException, BetTimeException, ConfigException, BetValueException
-from TestBot.embeds import winning_bet, losing_bet, bet_time_exception_embed
+from TestBot.opendota.client import AsyncDotaClient
+from TestBot.opendota.ratelimit import api_keys
+from TestBot.utils import get_queue_logger, process_memory
+from TestBot.exceptions import BalanceException, ConfigException, BetValueException
+from TestBot.settlement import SettlementBatcher, bet_kind
+from TestBot.sharding import HashRing
 
 # init log
 ROOT = os.environ["ROOT"]
 
 # load constants
-API_KEY = os.environ['OD_API_KEY']
+API_KEYS = api_keys()
+BET_CONCURRENCY = int(os.environ.get("BET_CONCURRENCY", DEFAULT_CONCURRENCY))
+DB_THREADS = int(os.environ.get("DB_THREADS", 32))
+JOURNAL_PATH = f"{ROOT}/data/journal.db"
+WATCH_TIMEOUT = 80 * 60
 
 # instantiate open dota client
-od_client = SyncDotaClient(API_KEY)
-async_client = AsyncDotaClient(API_KEY)
+async_client = AsyncDotaClient(API_KEYS)
+
+# Executors for blocking work; boto3 calls go to `io_executor`. Pricing and plotting share a single
+# thread in `cpu_executor` as pyplot is not thread-safe.
+io_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+cpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pricing")
 
 # Instantiate DB handler
 session = aioboto3.Session()
@@ -39,9 +52,15 @@ read_timeout = 5
 )
 db = DynamoHandler(boto3.resource('dynamodb', config=db_config), boto3.client('dynamodb'), session)
 
-# Instantiate pricing model
-s3 = boto3.resource("s3")
-pricing_model = PricingModel(s3)
+# Pricing model, set by `load_pricing_model`. The parent loads it before forking the workers so they share
+# the model pages copy-on-write instead of each loading its own; importing this module needs no S3 access.
+pricing_model: PricingModel = None
+
+def load_pricing_model() -> PricingModel:
+    global pricing_model
+    if pricing_model is None:
+        pricing_model = PricingModel(boto3.resource("s3"))
+    return pricing_model
 
 def process_outcome(outcome: str):
     # Uses natural language process to parse the `outcome` arg, improving robustness.
@@ -103,485 +122,193 @@ def validate_args_member(args: Dict, c_id: str) -> Dict:
     args["BeteeSteamID"] = bettee_steamid
     return args
 
-def bet_work(id: int, input_queue: multiprocessing.Queue, output_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue) -> None:
-    print(f"Worker {id} activated...")
-    while True:
-        if input_queue.empty():
-            time.sleep(30)
-        else:
-            args = input_queue.get()
-            if "TeamID" in args.keys():
-                thread = threading.Thread(target = team_bet, args=(args, output_queue, log_queue))
-                thread.start()            
-            elif "Username" in args.keys():
-                thread = threading.Thread(target = user_bet, args=(args, output_queue, log_queue))
-                thread.start()  
-            else:
-                thread = threading.Thread(target = member_bet, args=(args, output_queue, log_queue))
-                thread.start()  
-
-def member_bet(args: Dict, output_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue) -> disnake.Embed:
-    c_id = args["cmd_id"]
+class BetAborted(Exception):
+    def __init__(self, level: int, msg: str, embed: disnake.Embed, refund: bool = False, in_play: bool = False):
+        """
+        Raised by a stage of the bet lifecycle to stop the bet. Carries the
+        log message, the embed sent back to the user and whether the stake
+        (and the `InPlay` record) should be refunded.
+        """
+        self.level = level
+        self.msg = msg
+        self.embed = embed
+        self.refund = refund
+        self.in_play = in_play
+
+async def run_io(fn: Callable, *args, **kwargs):
+    # Runs a blocking (boto3) call without blocking the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, functools.partial(fn, *args, **kwargs))
+
+async def refund(args: Dict, c_id: str, in_play: bool = True) -> None:
+    await run_io(db.update_balance, args["UserID"], args["Value"], Action.INCREMENT, c_id)
+    if in_play:
+        await run_io(db.delete_in_play, c_id)
+
+async def validate(args: Dict, c_id: str) -> Dict:
+    # Standardise args
     try:
-            # Standardise args
-        try:
-            args = standardise_args(args)
-        except BetValueException as e:
-            # log message to log-worker
-            log_queue.put(LogMessage(logging.WARNING, f"Negative bet value, bet failed. value: {e.value}", c_id))
-            # send output to user via parent process
-            embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` value. Bet value must be greater than 0.")
-            output_queue.put((args, embed))
-            return
-        except ValueError as e:
-            # log message to log-worker
-            log_queue.put(LogMessage(logging.WARNING, f"Incorrect argument formatting raised exception. Argument: {e.args[0]}", c_id))
-            # send output to user via parent process
-            embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` syntax. Check `help` for examples.")
-            output_queue.put((args, embed))
-            return
-
-        # Valiate user (check for config)
-        try:
-            args = validate_args_member(args, c_id)
-        except ConfigException as e:
-            log_queue.put(LogMessage(logging.WARNING, "Failed to validate bet arguments.", c_id))
-            embed = disnake.Embed(title = "Config Error", description=f"Has the user you are betting on configured their profile with `steamconfig`?")
-            output_queue.put((args, embed))
-            return
-        except Exception as e:
-            # to catch generic errors
-            log_queue.put(LogMessage(logging.WARNING, "Failed to validate bet arguments.", c_id))
-            embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Store initial balance
-        response, init_balance = db.get_balance(args["UserID"], c_id)
-        if (not response) or (not init_balance):
-            log_queue.put(LogMessage(logging.WARNING, "Failed to obtain initial balance.", c_id))
-            embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Conditional update on DB balance; avoids race condition
-        try:
-            db.update_balance(args["UserID"], args["Value"], Action.DECREMENT, c_id, condition_expression="Balance >= :amount_change")
-        except BalanceException as e:
-            log_queue.put(LogMessage(logging.WARNING, "Balance exception occured during `update_balance` operation.", c_id))
-            embed = disnake.Embed(title = "Balance Error", description =  "Invalid balance. The `bet` value exceeds your current balance.",\
-                                    fields = [{"name":"Current Balance", "value":str(e.balance)}, {"name":"Bet Value", "value":str(e.value)}])                                    
-            output_queue.put((args, embed))
-            return
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, "General exception occurred during `update_balance` operation of `bet` command", c_id))
-            embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-
-        # Log bets to `InPlay` database
-        try:
-            db.log_in_play_bet(args, c_id)
-        except Exception:
-            log_queue.put(LogMessage(logging.CRITICAL, "Unable to log `member_bet` to in play database", c_id))
-            embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            return
-
-        # Get a new `match_id` 
-        try: 
-            latest_match_id = od_client.wait_new_id_player(args["BeteeSteamID"], c_id)
-        except TimeoutError as e:
-            log_queue.put(LogMessage(logging.WARNING, "Waiting for new game timeout exception occurred during `bet` command", c_id))
-            embed = disnake.Embed(title = "Timeout Error", description=f"No new game was found. Was this a turbo game? Turbo games are currently not supported. If not this is likely a server error with OpenDota. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return 
-
-        try:
-            data = od_client.parse_match_get_data(latest_match_id, c_id)
-        except TimeoutError as e:
-            log_queue.put(LogMessage(logging.WARNING, "Parsing timeout occured during `bet`.", c_id))
-            embed = disnake.Embed(title = "Timeout Error", description="Parse request timed out. Likely an OpenDota server error. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return 
-
-        try:
-            odds, payout = pricing_model(data, args, c_id)
-        except LobbyTypeException as e:
-            log_queue.put(LogMessage(logging.WARNING, "`LobbyTypeException` exception {str(e)} raised while calculating odds and payout", c_id))
-            embed = disnake.Embed(title = "Lobby Error", description=f"Incorrect lobby type being bet on. Bet Refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-        except BetTimeException as e:
-            log_queue.put(LogMessage(logging.WARNING, f"`BetTimeException` exception {str(e)} raised while calculating odds and payout", c_id))
-            embed = bet_time_exception_embed(e)
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, f"General exception {str(e)} raised while executing bet", c_id))
-            embed = disnake.Embed(title = "Bet Error", description="Error executing the bet. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-        
-        # Process bet outcomes based on payouts
-        if payout > 0:
-            embed = winning_bet(args, odds, payout, c_id) 
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], payout, Action.INCREMENT, c_id)
-            delta = payout
-        else:
-            embed = losing_bet(args, odds, payout, c_id)
-            output_queue.put((args, embed))
-            delta = -1*args["Value"]
-
-        # Once bet is succesfully completed, can log the bet in the BetHistory DB.
-        bet_data = {
-            "UserID": args["UserID"],
-            "BetID": c_id,  # Unique identifier for the bet
-            "MatchID": latest_match_id,
-            "Timestamp": args["Timestamp"],
-            "BeteeID": args["BeteeID"],
-            "Outcome": args["Outcome"],
-            "Value": args["Value"],
-            "Odds": str(odds),
-            "BalanceDelta": delta,
-            "NewBalance": init_balance + delta,
-            "GuildID": args["GuildID"]
-        }
-        # Delete bet from `inPlay` database and log to completed database
-        try:
-            db.delete_in_play(c_id)
-            db.log_completed_bet(bet_data, c_id)
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, "Failed to log bet in DynamoDB", c_id))
-    except:
-        trace = traceback.format_exc()
-        log_queue.put(LogMessage(logging.CRITICAL, f"Unknown exception occured during `member_bet`. Traceback:\n {str(trace)}", c_id))
-        db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-        db.delete_in_play(c_id)
-
-def team_bet(args: Dict, output_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue) -> disnake.Embed:
+        args = standardise_args(args)
+    except BetValueException as e:
+        embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` value. Bet value must be greater than 0.")
+        raise BetAborted(logging.WARNING, f"Negative bet value, bet failed. value: {e.value}", embed)
+    except ValueError as e:
+        embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` syntax. Check `help` for examples.")
+        raise BetAborted(logging.WARNING, f"Incorrect argument formatting raised exception. Argument: {e.args[0]}", embed)
+
+    # Valiate user (check for config)
+    kind = bet_kind(args)
+    validator = {"member": validate_args_member, "team": validate_args_team, "user": validate_args_user}[kind]
+    try:
+        return await run_io(validator, args, c_id)
+    except ConfigException:
+        if kind == "user":
+            embed = disnake.Embed(title = "Config Error", description=f"Have you correctly configured the profile of the user? Check `/configured_users` to see all configured users in the server.")
+            raise BetAborted(logging.WARNING, "Failed to validate bet arguments. User likely doesn't exist.", embed)
+        embed = disnake.Embed(title = "Config Error", description=f"Has the user you are betting on configured their profile with `steamconfig`?")
+        raise BetAborted(logging.WARNING, "Failed to validate bet arguments.", embed)
+    except Exception:
+        # to catch generic errors
+        embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
+        raise BetAborted(logging.WARNING, "Failed to validate bet arguments.", embed)
+
+async def debit(args: Dict, c_id: str) -> Decimal:
+    # Store initial balance
+    response, init_balance = await run_io(db.get_balance, args["UserID"], c_id)
+    if (not response) or (not init_balance):
+        embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
+        raise BetAborted(logging.WARNING, "Failed to obtain initial balance.", embed)
+
+    # Conditional update on DB balance; avoids race condition
+    try:
+        await run_io(db.update_balance, args["UserID"], args["Value"], Action.DECREMENT, c_id, condition_expression="Balance >= :amount_change")
+    except BalanceException as e:
+        embed = disnake.Embed(title = "Balance Error", description =  "Invalid balance. The `bet` value exceeds your current balance.",\
+                                fields = [{"name":"Current Balance", "value":str(e.balance)}, {"name":"Bet Value", "value":str(e.value)}])
+        raise BetAborted(logging.WARNING, "Balance exception occured during `update_balance` operation.", embed)
+    except Exception:
+        embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
+        raise BetAborted(logging.WARNING, "General exception occurred during `update_balance` operation of `bet` command", embed)
+
+    # Log bets to `InPlay` database
+    try:
+        await run_io(db.log_in_play_bet, args, c_id)
+    except Exception:
+        embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
+        raise BetAborted(logging.CRITICAL, f"Unable to log `{bet_kind(args)}_bet` to in play database", embed, refund=True)
+    return init_balance
+
+async def watch(args: Dict, c_id: str, init_balance: Decimal, journal: BetJournal, baseline: int = None) -> int:
+    # Get a new `match_id`; the timeout counts from when the bet was placed so resumed bets do not wait longer
+    timeout = max(0, WATCH_TIMEOUT - (time.time() - args["Timestamp"]))
+    on_subscribe = lambda latest_id: journal.record(WATCHING, args, latest_id, init_balance)
+    try:
+        if bet_kind(args) == "team":
+            return await async_client.wait_new_id_team(args["TeamID"], c_id, timeout, baseline, on_subscribe, args["Timestamp"])
+        return await async_client.wait_new_id_player(args["BeteeSteamID"], c_id, timeout, baseline, on_subscribe, args["Timestamp"])
+    except TimeoutError:
+        embed = disnake.Embed(title = "Timeout Error", description=f"No new game was found. Was this a turbo game? Turbo games are currently not supported. If not this is likely a server error with OpenDota. Bet refunded.")
+        raise BetAborted(logging.WARNING, "Waiting for new game timeout exception occurred during `bet` command", embed, refund=True, in_play=True)
+
+async def parse(match_id: int, c_id: str) -> Dict:
+    # Parse new game and extract stats
+    try:
+        return await async_client.parse_match_get_data(match_id, c_id, projected=True)
+    except (TimeoutError, asyncio.TimeoutError):
+        embed = disnake.Embed(title = "Timeout Error", description="Parse request timed out. Likely an OpenDota server error. Bet refunded.")
+        raise BetAborted(logging.WARNING, "Parsing timeout occured during `bet`.", embed, refund=True, in_play=True)
+
+async def run_bet(args: Dict, output_queue: multiprocessing.Queue, log: logging.Logger, settlement: SettlementBatcher,
+                  journal: BetJournal, entry: JournalEntry = None) -> None:
+    # Full lifecycle of a single bet: validate, debit, watch, parse, then price and settle with every other bet on the match.
+    # Each stage is journaled; passing `entry` resumes a debited bet from its last journaled stage.
     c_id = args["cmd_id"]
-    
+    debited, settled = False, False
     try:
-        # Standardise args
-        try:
-            args = standardise_args(args)
-        except BetValueException as e:
-            # log message to log-worker
-            log_queue.put(LogMessage(logging.WARNING, f"Negative bet value, bet failed. value: {e.value}", c_id))
-            # send output to user via parent process
-            embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` value. Bet value must be greater than 0.")
-            output_queue.put((args, embed))
-            return
-        except ValueError as e:
-            # log message to log-worker
-            log_queue.put(LogMessage(logging.WARNING, f"Incorrect argument formatting raised exception {e.args[0]}", c_id))
-            # send output to user via parent process
-            embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` syntax. Check `help` for examples.")
-            output_queue.put((args, embed))
-            return
-        
-        # Valiate user (check for config)
-        try:
-            args = validate_args_member(args, c_id)
-        except ConfigException as e:
-            log_queue.put(LogMessage(logging.WARNING, "Failed to validate bet arguments.", c_id))
-            embed = disnake.Embed(title = "Config Error", description=f"Has the user you are betting on configured their profile with `steamconfig`?")
-            output_queue.put((args, embed))
-            return
-        except Exception as e:
-            # to catch generic errors
-            log_queue.put(LogMessage(logging.WARNING, "Failed to validate bet arguments.", c_id))
-            embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Store initial balance
-        response, init_balance = db.get_balance(args["UserID"], c_id)
-        if (not response) or (not init_balance):
-            log_queue.put(LogMessage(logging.WARNING, "Failed to obtain initial balance.", c_id))
-            embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Conditional update on DB balance; avoids race condition
-        try:
-            db.update_balance(args["UserID"], args["Value"], Action.DECREMENT, c_id, condition_expression="Balance >= :amount_change")
-        except BalanceException as e:
-            log_queue.put(LogMessage(logging.WARNING, "Balance exception occured during `update_balance` operation.", c_id))
-            embed = disnake.Embed(title = "Balance Error", description =  "Invalid balance. The `bet` value exceeds your current balance.",\
-                                    fields = [{"name":"Current Balance", "value":str(e.balance)}, {"name":"Bet Value", "value":str(e.value)}])                                    
-            output_queue.put((args, embed))
-            return
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, "General exception occurred during `update_balance` operation of `bet` command", c_id))
-            embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Log bets to `InPlay` database
-        try:
-            db.log_in_play_bet(args, c_id)
-        except Exception:
-            log_queue.put(LogMessage(logging.CRITICAL, "Unable to log `team_bet` to in play database", c_id))
-            embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            return
-
-        # Get a new `match_id` 
-        try: 
-            latest_match_id = od_client.wait_new_id_team(args["TeamID"], c_id)
-        except TimeoutError as e:
-            log_queue.put(LogMessage(logging.WARNING, "Waiting for new game timeout exception occurred during `bet` command", c_id))
-            embed = disnake.Embed(title = "Timeout Error", description=f"No new game was found. Was this a turbo game? Turbo games are currently not supported. If not this is likely a server error with OpenDota. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return 
-        
-        # Parse new game and extract stats
-        try:
-            data = od_client.parse_match_get_data(latest_match_id, c_id)
-        except TimeoutError as e:
-            log_queue.put(LogMessage(logging.WARNING, "Parsing timeout occured during `bet`.", c_id))
-            embed = disnake.Embed(title = "Timeout Error", description="Parse request timed out. Likely an OpenDota server error. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return 
-        
-        # Run the blocking pricing call in a separate thread
-        try:
-            odds, payout = pricing_model(data, args, c_id)
-        except LobbyTypeException as e:
-            log_queue.put(LogMessage(logging.WARNING, "`LobbyTypeException` exception {str(e)} raised while calculating odds and payout", c_id))
-            embed = disnake.Embed(title = "Lobby Error", description=f"Incorrect lobby type being bet on. Bet Refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-
-        except BetTimeException as e:
-            log_queue.put(LogMessage(logging.WARNING, "`BetTimeException` exception {str(e)} raised while calculating odds and payout", c_id))
-            embed = bet_time_exception_embed(e)
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, f"General exception {str(e)} raised while executing bet", c_id))
-            embed = disnake.Embed(title = "Bet Error", description="Error executing the bet. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-        
-        # Process bet outcomes based on payouts
-        if payout > 0:
-            embed = winning_bet(args, odds, payout, c_id) 
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], payout, Action.INCREMENT, c_id)
-            delta = payout
+        if entry is None:
+            journal.record(QUEUED, args)
+            args = await validate(args, c_id)
+            init_balance = await debit(args, c_id)
+            journal.record(DEBITED, args, init_balance=init_balance)
+            stage, match_id = DEBITED, None
         else:
-            embed = losing_bet(args, odds, payout, c_id)
-            output_queue.put((args, embed))
-            delta = -1*args["Value"]
-
-        # Once bet is succesfully completed, can log the bet in the BetHistory DB.
-        bet_data = {
-            "UserID": args["UserID"],
-            "BetID": c_id,  # Unique identifier for the bet
-            "MatchID": latest_match_id,
-            "Timestamp": args["Timestamp"],
-            "BeteeID": args["BeteeID"],
-            "Outcome": args["Outcome"],
-            "Value": args["Value"],
-            "Odds": str(odds),
-            "BalanceDelta": delta,
-            "NewBalance": init_balance + delta,
-            "GuildID": args["GuildID"]
-        }
-
-        # Delete bet from `inPlay` database and log to completed database
-        try:
-            db.delete_in_play(c_id)
-            db.log_completed_bet(bet_data, c_id)
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, "Failed to log bet in DynamoDB", c_id))
-    except:
+            init_balance, stage, match_id = entry.init_balance, entry.stage, entry.match_id
+        debited = True
+        if stage != PARSING:
+            match_id = await watch(args, c_id, init_balance, journal, baseline=match_id)
+            journal.record(PARSING, args, match_id, init_balance)
+        data = await parse(match_id, c_id)
+        settled = True
+        await settlement.settle(match_id, data, args, c_id, init_balance)
+    except BetAborted as e:
+        log.log(e.level, e.msg, extra={"id":c_id})
+        output_queue.put((args, e.embed))
+        if e.refund:
+            await refund(args, c_id, e.in_play)
+    except Exception:
         trace = traceback.format_exc()
-        log_queue.put(LogMessage(logging.CRITICAL, f"Unknown exception occured during `member_bet`. Traceback:\n {str(trace)}", c_id))
-        db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-        db.delete_in_play(c_id)
-
-
-def user_bet(args: Dict, output_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue) -> disnake.Embed:
-    c_id = args["cmd_id"]
+        log.log(logging.CRITICAL, f"Unknown exception occured during `{bet_kind(args)}_bet`. Traceback:\n {str(trace)}", extra={"id":c_id})
+        if debited and not settled:
+            await refund(args, c_id)
+    journal.record(SETTLED, args)
+
+async def drop_bet(entry: JournalEntry, output_queue: multiprocessing.Queue, log: logging.Logger, journal: BetJournal) -> None:
+    # A bet that was queued but not journaled as debited when the worker stopped; refund it if the debit went through
+    args, c_id = entry.args, entry.cmd_id
     try:
-        # Standardise args
-        try:
-            args = standardise_args(args)
-        except BetValueException as e:
-            # log message to log-worker
-            log_queue.put(LogMessage(logging.WARNING, f"Negative bet value, bet failed. value: {e.value}", c_id))
-            # send output to user via parent process
-            embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` value. Bet value must be greater than 0.")
-            output_queue.put((args, embed))
-            return
-        except ValueError as e:
-            # log message to log-worker
-            log_queue.put(LogMessage(logging.WARNING, f"Incorrect argument formatting raised exception {e.args[0]}", c_id))
-            # send output to user via parent process
-            embed = disnake.Embed(title = "Syntax Error", description="Invalid `bet` syntax. Check `help` for examples.")
-            output_queue.put((args, embed))
-            return
-        
-        # Valiate user (check for config)
-        try:
-            args = validate_args_user(args, c_id)
-        except ConfigException as e:
-            log_queue.put(LogMessage(logging.WARNING, "Failed to validate bet arguments. User likely doesn't exist.", c_id))
-            embed = disnake.Embed(title = "Config Error", description=f"Have you correctly configured the profile of the user? Check `/configured_users` to see all configured users in the server.")
-            output_queue.put((args, embed))
-            return
-        except Exception as e:
-            # to catch generic errors
-            log_queue.put(LogMessage(logging.WARNING, "Failed to validate bet arguments.", c_id))
-            embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Store initial balance
-        response, init_balance = db.get_balance(args["UserID"], c_id)
-        if (not response) or (not init_balance):
-            log_queue.put(LogMessage(logging.WARNING, "Failed to obtain initial balance.", c_id))
-            embed = disnake.Embed(title = "Error", description=f"Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Conditional update on DB balance; avoids race condition
-        try:
-            db.update_balance(args["UserID"], args["Value"], Action.DECREMENT, c_id, condition_expression="Balance >= :amount_change")
-        except BalanceException as e:
-            log_queue.put(LogMessage(logging.WARNING, "Balance exception occured during `update_balance` operation.", c_id))
-            embed = disnake.Embed(title = "Balance Error", description =  "Invalid balance. The `bet` value exceeds your current balance.",\
-                                    fields = [{"name":"Current Balance", "value":str(e.balance)}, {"name":"Bet Value", "value":str(e.value)}])                                    
-            output_queue.put((args, embed))
-            return
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, "General exception occurred during `update_balance` operation of `bet` command", c_id))
-            embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            return
-        
-        # Log bets to `InPlay` database 
-        try:
-            db.log_in_play_bet(args, c_id)
-        except Exception:
-            log_queue.put(LogMessage(logging.CRITICAL, "Unable to log `user_bet` to in play database", c_id))
-            embed = disnake.Embed(title = "Error", description =  "Something went wrong, please try again later.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            return
-
-        # Get a new `match_id` 
-        try: 
-            latest_match_id = od_client.wait_new_id_player(args["BeteeSteamID"], c_id)
-        except TimeoutError as e:
-            log_queue.put(LogMessage(logging.WARNING, "Waiting for new game timeout exception occurred during `bet` command", c_id))
-            embed = disnake.Embed(title = "Timeout Error", description=f"No new game was found. Was this a turbo game? Turbo games are currently not supported. If not this is likely a server error with OpenDota. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return 
-        
-        # Parse new game and extract stats
-        try:
-            data = od_client.parse_match_get_data(latest_match_id, c_id)
-        except TimeoutError as e:
-            log_queue.put(LogMessage(logging.WARNING, "Parsing timeout occured during `bet`.", c_id))
-            embed = disnake.Embed(title = "Timeout Error", description="Parse request timed out. Likely an OpenDota server error. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return 
-        
-        # Run the blocking pricing call in a separate thread
-        try:
-            odds, payout = pricing_model(data, args, c_id)
-        except LobbyTypeException as e:
-            log_queue.put(LogMessage(logging.WARNING, f"`LobbyTypeException` exception {str(e)} raised while calculating odds and payout", c_id))
-            embed = disnake.Embed(title = "Lobby Error", description=f"Incorrect lobby type being bet on. Bet Refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-
-        except BetTimeException as e:
-            log_queue.put(LogMessage(logging.WARNING, f"`BetTimeException` exception {str(e)} raised while calculating odds and payout", c_id))
-            embed = bet_time_exception_embed(e)
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, f"General exception {str(e)} raised while executing bet", c_id))
-            embed = disnake.Embed(title = "Bet Error", description="Error executing the bet. Bet refunded.")
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-            db.delete_in_play(c_id)
-            return
-        
-        # Process bet outcomes based on payouts
-        if payout > 0:
-            embed = winning_bet(args, odds, payout, c_id) 
-            output_queue.put((args, embed))
-            db.update_balance(args["UserID"], payout, Action.INCREMENT, c_id)
-            delta = payout
+        if await run_io(db.check_in_play, c_id):
+            await refund(standardise_args(args), c_id)
+        embed = disnake.Embed(title = "Bet Cancelled", description="The bot restarted before your bet was placed. Please place it again.")
+        output_queue.put((args, embed))
+        log.log(logging.WARNING, "Dropped bet queued before restart.", extra={"id":c_id})
+    except Exception:
+        trace = traceback.format_exc()
+        log.log(logging.CRITICAL, f"Failed to drop bet queued before restart. Traceback:\n {str(trace)}", extra={"id":c_id})
+    journal.record(SETTLED, args)
+
+def replay(id: int, n_workers: int, journal: BetJournal, output_queue: multiprocessing.Queue, log: logging.Logger, settlement: SettlementBatcher,
+           dispatcher: BetDispatcher) -> None:
+    # Restarts every unsettled bet in this worker's shard through the dispatcher, so resumed bets count towards its
+    # concurrency limit; one journal query, no DynamoDB calls for debited bets
+    start = time.time()
+    journal.compact()
+    ring = HashRing(n_workers)
+    resumed = 0
+    for entry in journal.unsettled():
+        if ring.shard(entry.shard_key) != id:
+            continue
+        if entry.stage == QUEUED:
+            dispatcher.resume(entry.cmd_id, functools.partial(drop_bet, entry, output_queue, log, journal))
         else:
-            embed = losing_bet(args, odds, payout, c_id)
-            output_queue.put((args, embed))
-            delta = -1*args["Value"]
-
-        # Once bet is succesfully completed, can log the bet in the BetHistory DB.
-        bet_data = {
-            "UserID": args["UserID"],
-            "BetID": c_id,  # Unique identifier for the bet
-            "MatchID": latest_match_id,
-            "Timestamp": args["Timestamp"],
-            "BeteeUsername": args["Username"],
-            "Outcome": args["Outcome"],
-            "Value": args["Value"],
-            "Odds": str(odds),
-            "BalanceDelta": delta,
-            "NewBalance": init_balance + delta,
-            "GuildID": args["GuildID"]
-        }
+            dispatcher.resume(entry.cmd_id, functools.partial(run_bet, entry.args, output_queue, log, settlement, journal, entry))
+        resumed += 1
+    log.log(logging.INFO, f"Worker {id} resumed {resumed} bets from the journal in {time.time() - start:.3f}s.", extra={"id":"journal"})
+
+async def serve(id: int, n_workers: int, input_queue: multiprocessing.Queue, output_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue,
+                started: float, inherited: bool) -> None:
+    loop = asyncio.get_running_loop()
+    log = get_queue_logger(log_queue)
+    journal = BetJournal(JOURNAL_PATH)
+    settlement = SettlementBatcher(db, pricing_model, cpu_executor, io_executor, output_queue, log)
+    handler = functools.partial(run_bet, output_queue=output_queue, log=log, settlement=settlement, journal=journal)
+    dispatcher = BetDispatcher(input_queue, handler, log, loop, concurrency=BET_CONCURRENCY)
+    replay(id, n_workers, journal, output_queue, log, settlement, dispatcher)
+    memory = process_memory()
+    log.log(logging.INFO, f"Worker {id} ready {time.time() - started:.3f}s after start with {'inherited' if inherited else 'freshly loaded'} "
+                          f"pricing model; rss {memory.get('rss', 0):.1f} MB, pss {memory.get('pss', 0):.1f} MB, "
+                          f"private {memory.get('private', 0):.1f} MB.", extra={"id":"worker"})
+    # The dispatcher blocks on the queue, so it gets a thread of its own
+    try:
+        await loop.run_in_executor(None, dispatcher.run)
+    finally:
+        await async_client.aclose()
 
-        # Delete bet from `inPlay` database and log to completed database
-        try:
-            db.delete_in_play(c_id)
-            db.log_completed_bet(bet_data, c_id)
-        except Exception as e:
-            log_queue.put(LogMessage(logging.WARNING, "Failed to log bet in DynamoDB", c_id))
-    except:
-        trace = traceback.format_exc()
-        log_queue.put(LogMessage(logging.CRITICAL, f"Unknown exception occured during `user_bet`. Traceback:\n {str(trace)}", c_id))
-        db.update_balance(args["UserID"], args["Value"], Action.INCREMENT, c_id)
-        db.delete_in_play(c_id)
\ No newline at end of file
+def bet_work(id: int, n_workers: int, input_queue: multiprocessing.Queue, output_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue,
+             started: float = None) -> None:
+    # `started` is when the parent started this worker; startup time and memory are logged once it is ready
+    print(f"Worker {id} activated...")
+    started = started or time.time()
+    # Already set when forked from a parent that called `load_pricing_model`; loaded here otherwise (e.g. spawn)
+    inherited = pricing_model is not None
+    load_pricing_model()
+    asyncio.run(serve(id, n_workers, input_queue, output_queue, log_queue, started, inherited))
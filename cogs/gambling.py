@@ -5,11 +5,11 @@ from fuzzywuzzy import fuzz
 import logging
 import os
 import time
-import multiprocessing
 from typing import Dict
 from uuid import uuid4
 
 from TestBot.database.dynamo import DynamoHandler, Action
+from TestBot.sharding import ShardedQueue
 from TestBot.teams import team_names, teams
 from TestBot.utils import get_logger
 from TestBot.embeds import successful_cmd, unsuccessful_cmd 
@@ -20,7 +20,7 @@ logger = get_logger(dir=f"{ROOT}/data/logs", filename="Gambling.log", level=logg
 
 class Gambling(commands.Cog, name = "Gambling"):
     """Commands related to the gambling functionality."""
-    def __init__(self, bot: commands.Bot, db_handler: DynamoHandler, bets_queue: multiprocessing.Queue):
+    def __init__(self, bot: commands.Bot, db_handler: DynamoHandler, bets_queue: ShardedQueue):
         self.bot = bot
         self.db = db_handler
         self.queue = bets_queue
@@ -67,7 +67,8 @@ class Gambling(commands.Cog, name = "Gambling"):
                 "BeteeID": betee.id,
                 "Outcome": outcome,
                 "Value": value,
-                "cmd_id": str(c_id)}
+                "cmd_id": str(c_id),
+                "QueuedAt": time.time()}
         self.queue.put(args, block=False)
         await successful_cmd(inter)
 
@@ -84,7 +85,8 @@ class Gambling(commands.Cog, name = "Gambling"):
                 "TeamID": teams[team]["team_id"],
                 "Outcome": outcome,
                 "Value": value,
-                "cmd_id": str(c_id)}
+                "cmd_id": str(c_id),
+                "QueuedAt": time.time()}
         self.queue.put(args, block=False)
         await successful_cmd(inter)
 
@@ -100,7 +102,8 @@ class Gambling(commands.Cog, name = "Gambling"):
                 "Username": username,
                 "Outcome": outcome,
                 "Value": value,
-                "cmd_id": str(c_id)}
+                "cmd_id": str(c_id),
+                "QueuedAt": time.time()}
         self.queue.put(args, block=False)
         await successful_cmd(inter)
 
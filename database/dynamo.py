@@ -1,6 +1,7 @@
 import aioboto3 
 import boto3 
 from boto3.dynamodb.conditions import Key
+from collections import defaultdict
 from decimal import Decimal
 from enum import Enum, auto
 import logging
@@ -158,6 +159,14 @@ class DynamoHandler:
             log.error(f"An exception occured during `delete_in_play`", exc_info=True, extra={"id":"NULL"})
             raise Exception
 
+    def check_in_play(self, _id: str) -> bool:
+        try:
+            response = self.db.Table(f"{VERSION}_InPlay").get_item(Key = {"cmd_id":_id})
+            return "Item" in response
+        except Exception as e:
+            log.error(f"An exception occured during `check_in_play`", exc_info=True, extra={"id":_id})
+            raise Exception
+
     def update_balance(self, user_id: int, amount_change: Decimal, operation: Action, cmd_id: int, condition_expression: str = None):
         # Base dict
         update_params = {"Key": {"UserID": user_id}, 
@@ -185,6 +194,64 @@ class DynamoHandler:
             else:
                 raise Exception
 
+    def _settle_items(self, bets: List[Tuple[str, int, Decimal]]) -> List[Dict]:
+        # Conditional `InPlay` deletes and one balance credit per user for (cmd_id, user_id, credit) bets
+        items = [{"Delete": {"TableName": f"{VERSION}_InPlay",
+                             "Key": {"cmd_id": {"S": _id}},
+                             "ConditionExpression": "attribute_exists(cmd_id)"}} for _id, _, _ in bets]
+        credits = defaultdict(Decimal)
+        for _, user_id, amount in bets:
+            credits[user_id] += amount
+        items += [{"Update": {"TableName": f"{VERSION}_Users",
+                              "Key": {"UserID": {"N": str(user_id)}},
+                              "UpdateExpression": "SET Balance = Balance + :amount_change",
+                              "ExpressionAttributeValues": {":amount_change": {"N": str(amount)}}}}
+                  for user_id, amount in credits.items() if amount > 0]
+        return items
+
+    def settle_bets(self, bets: List[Tuple[str, int, Decimal]], history: List[Dict], cmd_id: str = "NULL") -> List[str]:
+        # Settles (cmd_id, user_id, credit) bets at most once: each bet's `InPlay` delete, conditional on the item
+        # still existing, is in the same transaction as its credit, so settling a bet again after a restart credits
+        # nothing. Returns the cmd_ids settled by this call; `BetHistory` rows are written for those only.
+        try:
+            # Transactions hold up to 100 items; a user credited by several bets of a chunk takes one item
+            chunks, chunk = [], []
+            for bet in bets:
+                if len(self._settle_items(chunk + [bet])) > 100:
+                    chunks.append(chunk)
+                    chunk = []
+                chunk.append(bet)
+            if chunk:
+                chunks.append(chunk)
+
+            settled = []
+            for chunk in chunks:
+                try:
+                    self.client.transact_write_items(TransactItems=self._settle_items(chunk))
+                    settled += [_id for _id, _, _ in chunk]
+                    continue
+                except self.client.exceptions.TransactionCanceledException:
+                    pass
+                # Some of these bets were settled before a restart; settle the others one at a time
+                for bet in chunk:
+                    try:
+                        self.client.transact_write_items(TransactItems=self._settle_items([bet]))
+                        settled.append(bet[0])
+                    except self.client.exceptions.TransactionCanceledException as e:
+                        reasons = e.response.get("CancellationReasons") or [{}]
+                        if reasons[0].get("Code") != "ConditionalCheckFailed":
+                            raise
+                        log.warning(f"Bet {bet[0]} was already settled.", extra={"id":bet[0]})
+            # `batch_writer` buffers and sends in chunks of 25, retrying unprocessed items
+            with self.db.Table(f"{VERSION}_BetHistory").batch_writer() as batch:
+                for item in history:
+                    if item["BetID"] in settled:
+                        batch.put_item(Item=item)
+            return settled
+        except Exception as e:
+            log.error(f"An exception occured during `settle_bets`: {type(e).__name__}", exc_info=True, extra={"id":cmd_id})
+            raise Exception
+
     def load_in_play_bets(self, cmd_id: str = "NULL") -> List[Dict]:
         try:
             response = self.client.scan(TableName=f"{VERSION}_InPlay")
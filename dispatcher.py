@@ -0,0 +1,143 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+
+DEFAULT_CONCURRENCY = 20000
+DEFAULT_BATCH_SIZE = 32
+REPORT_INTERVAL = 60
+
+class DispatchStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.dispatched = 0
+        self.batches = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.depth_max = 0
+
+    def record_batch(self, size: int, depth: int):
+        with self._lock:
+            self.batches += 1
+            self.depth_max = max(self.depth_max, depth)
+
+    def record_dispatch(self, latency: float):
+        with self._lock:
+            self.dispatched += 1
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self) -> Dict:
+        # Returns the stats accumulated since the last snapshot and resets the counters
+        with self._lock:
+            mean = self.latency_total / self.dispatched if self.dispatched else 0.0
+            stats = {"dispatched": self.dispatched,
+                     "batches": self.batches,
+                     "latency_mean": mean,
+                     "latency_max": self.latency_max,
+                     "depth_max": self.depth_max}
+            self.reset()
+        return stats
+
+class BetDispatcher:
+    """Blocks on the bet queue and starts each bet as a task on the worker's event loop.
+
+    `run` is meant to be executed in its own thread. Bursts are drained in batches of up to `batch_size`
+    without waiting and handed to the loop in a single call. At most `concurrency` bets are open at once;
+    further bets stay on the queue until a slot frees up. Queue depth and dispatch latency (time between
+    the command being issued and work starting) are reported to the log worker every `report_interval` seconds.
+    Bets resumed from the journal with `resume` are started first and hold slots like any other bet.
+    """
+    def __init__(self, input_queue: multiprocessing.Queue, handler: Callable[[Dict], Awaitable[None]], log: logging.Logger,
+                 loop: asyncio.AbstractEventLoop, concurrency: int = DEFAULT_CONCURRENCY, batch_size: int = DEFAULT_BATCH_SIZE,
+                 report_interval: int = REPORT_INTERVAL):
+        self.input_queue = input_queue
+        self.handler = handler
+        self.log = log
+        self.loop = loop
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.stats = DispatchStats()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._tasks = set()
+        self._resumed: List[Tuple[str, Callable[[], Awaitable[None]]]] = []
+        self._last_report = time.time()
+
+    def queue_depth(self) -> int:
+        # `qsize` is not implemented on every platform (e.g. macOS)
+        try:
+            return self.input_queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def _next_batch(self) -> List[Dict]:
+        # Block until at least one bet arrives, then drain whatever else is already waiting
+        batch = [self.input_queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.input_queue.get_nowait())
+            except queue.Empty:
+                break
+        self.stats.record_batch(len(batch), self.queue_depth() + len(batch))
+        return batch
+
+    def resume(self, c_id: str, start: Callable[[], Awaitable[None]]) -> None:
+        # Queues a bet resumed from the journal; `run` starts it before taking new bets off the queue
+        self._resumed.append((c_id, start))
+
+    async def _run(self, c_id: str, start: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await start()
+        except Exception as e:
+            self.log.log(logging.ERROR, f"Unhandled exception {str(e)} in bet handler.", extra={"id":c_id})
+        finally:
+            self._slots.release()
+
+    def _start_batch(self, batch: List[Tuple[str, Callable[[], Awaitable[None]]]]) -> None:
+        # Runs on the event loop; keep a reference to each task so it is not garbage collected
+        for c_id, start in batch:
+            task = self.loop.create_task(self._run(c_id, start))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _submit_resumed(self) -> None:
+        for item in self._resumed:
+            self._slots.acquire()
+            self.loop.call_soon_threadsafe(self._start_batch, [item])
+        self._resumed = []
+
+    def _submit(self, batch: List[Dict]) -> None:
+        for args in batch:
+            # `QueuedAt` is only used for metrics and must not reach the database
+            queued_at = args.pop("QueuedAt", args["Timestamp"])
+            self._slots.acquire()
+            self.stats.record_dispatch(time.time() - queued_at)
+        work = [(args.get("cmd_id", "NULL"), functools.partial(self.handler, args)) for args in batch]
+        self.loop.call_soon_threadsafe(self._start_batch, work)
+
+    def _report(self) -> None:
+        now = time.time()
+        if (now - self._last_report) < self.report_interval:
+            return
+        self._last_report = now
+        stats = self.stats.snapshot()
+        if not stats["dispatched"]:
+            return
+        self.log.info(f"Dispatched {stats['dispatched']} bets in {stats['batches']} batches; "
+                      f"latency mean {stats['latency_mean']:.3f}s max {stats['latency_max']:.3f}s; "
+                      f"max queue depth {stats['depth_max']}; open bets {len(self._tasks)}; "
+                      f"current depth {self.queue_depth()}.", extra={"id":"dispatcher"})
+
+    def run(self) -> None:
+        self._submit_resumed()
+        while True:
+            self._submit(self._next_batch())
+            self._report()
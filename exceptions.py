@@ -50,4 +50,16 @@ class NoBetsException(Exception):
         lobby type for the `bet`.
         """
         # Add in the lobby type parameters
-        pass
\ No newline at end of file
+        pass
+
+class OpenDotaException(Exception):
+    def __init__(self, query, status=None, reason=""):
+        """
+        To be used when a request to the OpenDota API
+        fails after all retries, or with a status that
+        is not worth retrying.
+        """
+        super().__init__(f"`{query}` failed" + (f" with status code {status}" if status else "") + (f": {reason}" if reason else ""))
+        self.query = query
+        self.status = status
+        self.reason = reason
@@ -0,0 +1,77 @@
+import numpy as np
+from typing import Dict, List
+
+# Feature columns in model order, so each model's inputs are a view of the same row:
+#   draft: time, radiant hero ids (5), dire hero ids (5)
+#   stats: time, radiant xp/last hits/gold (5 each), dire xp/last hits/gold (5 each)
+DRAFT_FEATURES, STATS_FEATURES = 11, 31
+N_FEATURES = DRAFT_FEATURES + STATS_FEATURES
+SERIES = ("xp_t", "lh_t", "gold_t")
+
+def draft_view(X: np.array) -> np.array:
+    return X[:, :DRAFT_FEATURES]
+
+def stats_view(X: np.array) -> np.array:
+    return X[:, DRAFT_FEATURES:]
+
+def _series(values) -> np.array:
+    # `array` series of projected matches are read in place; lists are converted
+    if isinstance(values, np.ndarray):
+        return values
+    try:
+        return np.frombuffer(values, dtype=np.int32 if values.typecode == "i" else np.float64)
+    except (TypeError, AttributeError):
+        return np.asarray(values)
+
+def _teams(players: Dict) -> List[List[Dict]]:
+    # Radiant then dire, each ordered by lane as the models were trained
+    radiant = sorted([players[key] for key in players.keys() if players[key]["team"]==1],key = lambda x: x["lane"])
+    dire = sorted([players[key] for key in players.keys() if players[key]["team"]==-1],key = lambda x: x["lane"])
+    return [radiant, dire]
+
+def minutes(parsed_game: Dict) -> int:
+    return len(parsed_game["times"])
+
+def fill(parsed_game: Dict, out: np.array) -> np.array:
+    """Writes the features of every minute of a parsed game into `out`, one row per minute.
+
+    `out` must have `minutes(parsed_game)` rows and `N_FEATURES` columns; each column block is copied
+    straight from the game's series without building intermediate lists.
+    """
+    n = len(out)
+    times = _series(parsed_game["times"])
+    out[:, 0] = times
+    out[:, DRAFT_FEATURES] = times
+    column = DRAFT_FEATURES + 1
+    for t, team in enumerate(_teams(parsed_game["players"])):
+        out[:, 1 + 5 * t:6 + 5 * t] = [player["hero_id"] for player in team]
+        for field in SERIES:
+            for player in team:
+                out[:, column] = _series(player[field])[:n]
+                column += 1
+    return out
+
+def fill_many(parsed_games: List[Dict], out: np.array) -> np.array:
+    # Every minute of each game, stacked in order; `out` must have the total number of minutes as rows
+    start = 0
+    for game in parsed_games:
+        fill(game, out[start:start + minutes(game)])
+        start += minutes(game)
+    return out
+
+class FeatureBuilder:
+    """Builds feature rows into a float32 buffer that is reused between calls.
+
+    The returned arrays are views of the buffer and are only valid until the next call, so a builder
+    must not be shared between threads. The buffer grows to the next power of two when a call needs more rows.
+    """
+    def __init__(self, rows: int = 128):
+        self.buffer = np.empty((rows, N_FEATURES), dtype=np.float32)
+
+    def rows(self, n: int) -> np.array:
+        if n > len(self.buffer):
+            self.buffer = np.empty((1 << (n - 1).bit_length(), N_FEATURES), dtype=np.float32)
+        return self.buffer[:n]
+
+    def build_many(self, parsed_games: List[Dict]) -> np.array:
+        return fill_many(parsed_games, self.rows(sum(minutes(game) for game in parsed_games)))
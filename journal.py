@@ -0,0 +1,72 @@
+from decimal import Decimal
+import json
+import sqlite3
+import time
+from typing import Dict, List, Set
+
+from TestBot.sharding import shard_key
+
+# Stages of a bet, in order
+QUEUED = "queued"
+DEBITED = "debited"
+WATCHING = "watching"
+PARSING = "parsing"
+SETTLED = "settled"
+
+class JournalEntry:
+    def __init__(self, cmd_id: str, key: str, stage: str, match_id: int, state: str):
+        self.cmd_id = cmd_id
+        self.shard_key = key
+        self.stage = stage
+        self.match_id = match_id
+        state = json.loads(state)
+        self.args = state["args"]
+        if isinstance(self.args.get("Value"), str):
+            self.args["Value"] = Decimal(self.args["Value"])
+        self.init_balance = Decimal(state["init_balance"]) if state["init_balance"] is not None else None
+
+class BetJournal:
+    """Append-only SQLite journal of bet stages, shared by the bot and every bet worker.
+
+    Each stage change appends one row holding the bet's arguments, the balance before the bet
+    and the relevant `match_id` (the last seen id while watching, the game being parsed afterwards).
+    On restart the latest row of every unsettled bet is read back in a single query.
+    """
+    def __init__(self, path: str):
+        # WAL lets readers in other processes work alongside a writer; the connection is only
+        # ever used by one thread at a time but may be created and used on different ones
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                cmd_id TEXT NOT NULL,
+                                shard_key TEXT NOT NULL,
+                                stage TEXT NOT NULL,
+                                match_id INTEGER,
+                                state TEXT NOT NULL,
+                                created REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_cmd_id ON events (cmd_id)")
+
+    def record(self, stage: str, args: Dict, match_id: int = None, init_balance: Decimal = None) -> None:
+        state = json.dumps({"args": args, "init_balance": init_balance}, default=str)
+        self.conn.execute("INSERT INTO events (cmd_id, shard_key, stage, match_id, state, created) VALUES (?, ?, ?, ?, ?, ?)",
+                          (args["cmd_id"], shard_key(args), stage, match_id, state, time.time()))
+
+    def unsettled(self) -> List[JournalEntry]:
+        # Latest event of every bet that has not been settled
+        rows = self.conn.execute("""SELECT e.cmd_id, e.shard_key, e.stage, e.match_id, e.state FROM events e
+                                    JOIN (SELECT MAX(seq) AS seq FROM events GROUP BY cmd_id) latest ON e.seq = latest.seq
+                                    WHERE e.stage != ?""", (SETTLED,)).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def open_ids(self) -> Set[str]:
+        return {entry.cmd_id for entry in self.unsettled()}
+
+    def compact(self) -> None:
+        # Drops settled bets and every event superseded by a later one
+        self.conn.execute("DELETE FROM events WHERE cmd_id IN (SELECT cmd_id FROM events WHERE stage = ?)", (SETTLED,))
+        self.conn.execute("DELETE FROM events WHERE seq NOT IN (SELECT MAX(seq) FROM events GROUP BY cmd_id)")
+
+    def close(self) -> None:
+        self.conn.close()
@@ -5,34 +5,42 @@ from botocore.config import Config
 from decimal import Decimal
 import disnake
 from disnake.ext import commands
+import gc
 import json
 import logging
 import os 
 import matplotlib
+import time
 import multiprocessing 
 from multiprocessing import Queue
 matplotlib.use('Agg')
 
 from TestBot.database.dynamo import DynamoHandler, Action
-from TestBot.opendota.client import AsyncDotaClient, SyncDotaClient
+from TestBot.opendota.client import AsyncDotaClient
+from TestBot.opendota.ratelimit import api_keys
 from TestBot.cogs.users import User
-from TestBot.pricing import PricingModel
 from TestBot.cogs.guilds import Guild
 from TestBot.cogs.balance import Balance
 from TestBot.cogs.gambling import Gambling
 from TestBot.cogs.utils import Utils
 from TestBot.cogs.help import Help
-from TestBot.betting import bet_work
+from TestBot.betting import bet_work, load_pricing_model, JOURNAL_PATH
+from TestBot.journal import BetJournal
+from TestBot.sharding import ShardedQueue
 from TestBot.utils import get_logger, stream_outputs, stream_bet_logs
 
 ROOT = os.environ["ROOT"]
 log = get_logger(dir=f"{ROOT}/data/logs", filename="main.log", level=logging.ERROR)
 
 class MyClient(commands.Bot):
-    def __init__(self, output_queue, db, *args, **kwargs):
+    def __init__(self, output_queue, db, journal, *args, **kwargs):
         super().__init__(*args,**kwargs)
         self.output_queue = output_queue
         self.db = db
+        self.journal = journal
+        # Bets placed after this point belong to the running workers and are never refunded at startup
+        self.started_at = time.time()
+        self.output_stream = None
         
     async def on_ready(self):
         await self.change_presence(activity=disnake.Game(name='-25 mmr'))
@@ -51,8 +59,9 @@ class MyClient(commands.Bot):
             log.critical("`refund_bets` failed. Shutting down the bot.", exc_info=True, extra={"id":"NULL"})
             await self.close()  
             return
-        # stream outputs
-        self.loop.create_task(stream_outputs(self, self.output_queue))
+        # stream outputs; `on_ready` fires again after reconnects, but only one stream may consume the queue
+        if self.output_stream is None:
+            self.output_stream = self.loop.create_task(stream_outputs(self, self.output_queue))
 
     async def update_message(self):
         if "update.json" in os.listdir(f"{ROOT}/data/"):
@@ -75,11 +84,15 @@ class MyClient(commands.Bot):
         os.system(f"rm '{fp}'")
 
     def refund_bets(self):
+        # Bets with an unsettled journal entry are resumed by the workers; refund only the ones the journal does not know about.
+        # The journal is read first: a bet settled in the meantime has already been removed from `InPlay` when it is scanned.
         try:
+            resumable = self.journal.open_ids()
             bets = self.db.load_in_play_bets()
-            print(f"Refund bets: {bets}")
             if not bets:
                 return
+            bets = [bet for bet in bets if (bet["cmd_id"]["S"] not in resumable) and (int(bet["Timestamp"]["N"]) < self.started_at)]
+            print(f"Refund bets: {bets}")
             # refund bet and then delete from the database
             for bet in bets:
                 user, value = int(bet["UserID"]["N"]), Decimal(bet["Value"]["N"])
@@ -91,8 +104,8 @@ class MyClient(commands.Bot):
 async def main():
     # load token 
     TOKEN = os.environ["TOKEN"]
-    API_KEY = os.environ['OD_API_KEY']
-    N_WORKERS = 1
+    API_KEYS = api_keys()
+    N_WORKERS = int(os.environ.get("N_WORKERS", 1))
 
     # Declare intents
     intents = disnake.Intents.default()
@@ -109,24 +122,32 @@ async def main():
     db = DynamoHandler(boto3.resource('dynamodb', config=db_config), boto3.client('dynamodb'), session)
 
     # Instantiate OpenDota client
-    async_dota_client = AsyncDotaClient(API_KEY) 
+    async_dota_client = AsyncDotaClient(API_KEYS) 
 
-    # Instantiate worker queues 
-    input_queue = Queue()
+    # Instantiate worker queues; each worker owns one shard of the bet targets
+    input_queues = [Queue() for _ in range(N_WORKERS)]
+    input_queue = ShardedQueue(input_queues)
     output_queue = Queue()
     log_queue = Queue()
 
+    # Load the pricing model once, before forking, so the workers share its pages copy-on-write. `gc.freeze`
+    # moves everything allocated so far out of the collector's reach, so collections in the workers do not
+    # write to (and copy) the pages they inherited.
+    load_pricing_model()
+    gc.freeze()
+    context = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else None)
+
     # Initialise logger
-    worker = multiprocessing.Process(target = stream_bet_logs, args = (log_queue,), daemon=True)
+    worker = context.Process(target = stream_bet_logs, args = (log_queue,), daemon=True)
     worker.start()
 
     # Initialise workers
-    workers = [multiprocessing.Process(target = bet_work, args = (i, input_queue, output_queue, log_queue), daemon=True) for i in range(N_WORKERS)]
+    workers = [context.Process(target = bet_work, args = (i, N_WORKERS, input_queues[i], output_queue, log_queue, time.time()), daemon=True) for i in range(N_WORKERS)]
     for worker in workers:
         worker.start()
     
     # Instantiate bot
-    bot = MyClient(db = db, command_prefix = os.environ["PREFIX"], intents = intents, output_queue = output_queue)
+    bot = MyClient(db = db, journal = BetJournal(JOURNAL_PATH), command_prefix = os.environ["PREFIX"], intents = intents, output_queue = output_queue)
 
     # Add cogs
     bot.add_cog(User(bot, db_handler=db, dota_client=async_dota_client))
@@ -136,8 +157,11 @@ async def main():
     bot.add_cog(Utils(bot))
     bot.add_cog(Help(bot))
 
-    # Run bot
-    await bot.start(TOKEN)
+    # Run bot; pooled OpenDota connections are closed on shutdown
+    try:
+        await bot.start(TOKEN)
+    finally:
+        await async_dota_client.aclose()
 
 ###
 if __name__=="__main__":
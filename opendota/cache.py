@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+CACHE_SIZE = int(os.environ.get("OD_CACHE_SIZE", 512))
+
+# Seconds an entry stays fresh; `FOREVER` never expires, 0 is never stored
+FOREVER = float("inf")
+Ttl = Union[float, Callable[[Any], float]]
+
+def match_ttl(data: Dict) -> float:
+    # A match is immutable once parsed; until then `is_parsed` must see the latest state
+    if data and data.get("radiant_xp_adv"):
+        return FOREVER
+    return 0
+
+class CacheRule:
+    # `params`, if given, must all be present in a request's parameters for the rule to apply
+    def __init__(self, name: str, pattern: str, ttl: Ttl, params: Dict = None):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.ttl = ttl
+        self.params = params or {}
+
+    def matches(self, query: str, params: Dict = None) -> bool:
+        params = params or {}
+        return bool(self.pattern.search(query)) and all(params.get(k) == v for k, v in self.params.items())
+
+    def ttl_for(self, data: Any) -> float:
+        return self.ttl(data) if callable(self.ttl) else self.ttl
+
+# Queries without a matching rule (`live`, `parsedMatches`, `health`, ...) are never cached
+# Full `matches/{id}` payloads (~700 KB each once decoded) are never kept in memory; parsed ones are read back
+# from the `MatchStore` on disk. Only the projected matches used for pricing (~30 KB) are cached.
+RULES = [
+    CacheRule("projected_match", r"^matches/\d+$", match_ttl, params={"projection": "pricing"}),
+    CacheRule("match", r"^matches/\d+$", 0),
+    CacheRule("player_matches", r"^players/\d+/matches$", 10),
+    CacheRule("team_matches", r"^teams/\d+/matches$", 10),
+    CacheRule("player", r"^players/\d+$", 60 * 60),
+    CacheRule("constants", r"^constants/", 6 * 60 * 60),
+]
+
+class ResponseCache:
+    """In-memory LRU of decoded OpenDota responses with per-endpoint TTLs.
+
+    The first rule whose pattern matches the query decides how long its response stays fresh. Cached
+    values are shared between callers and must be treated as read-only. Hits, misses and LRU evictions
+    are counted per rule.
+    """
+    def __init__(self, rules: List[CacheRule] = None, maxsize: int = CACHE_SIZE):
+        self.rules = RULES if rules is None else rules
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # key -> (expiry, value, rule name)
+        self.entries: "OrderedDict[Hashable, Tuple[float, Any, str]]" = OrderedDict()
+        self.hits: Dict[str, int] = {rule.name: 0 for rule in self.rules}
+        self.misses: Dict[str, int] = {rule.name: 0 for rule in self.rules}
+        self.evictions: Dict[str, int] = {rule.name: 0 for rule in self.rules}
+
+    def rule(self, query: str, params: Dict = None) -> Optional[CacheRule]:
+        for rule in self.rules:
+            if rule.matches(query, params):
+                return rule
+        return None
+
+    @staticmethod
+    def key(query: str, params: Dict = None) -> Hashable:
+        return (query, tuple(sorted((k, str(v)) for k, v in (params or {}).items() if k != "api_key")))
+
+    def get(self, query: str, params: Dict = None) -> Tuple[bool, Any]:
+        # Returns (found, value)
+        rule = self.rule(query, params)
+        if rule is None:
+            return False, None
+        key = self.key(query, params)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits[rule.name] += 1
+                return True, entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses[rule.name] += 1
+        return False, None
+
+    def put(self, query: str, params: Dict, data: Any) -> None:
+        rule = self.rule(query, params)
+        if rule is None or data is None:
+            return
+        ttl = rule.ttl_for(data)
+        if ttl <= 0:
+            return
+        key = self.key(query, params)
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, data, rule.name)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                _, (_, _, name) = self.entries.popitem(last=False)
+                self.evictions[name] += 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {name: {"hits": self.hits[name], "misses": self.misses[name], "evictions": self.evictions[name]}
+                    for name in self.hits}
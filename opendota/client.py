@@ -1,22 +1,129 @@
 import asyncio
+from collections import defaultdict, deque
 import logging
 import os
-import requests
-from typing import Dict, List
+import random
+import threading
+from typing import Awaitable, Callable, Dict, List, Union
 import httpx 
 import time
 
-from TestBot.opendota.utils import check_response
+from TestBot.opendota.cache import ResponseCache
+from TestBot.opendota.projection import loads, project_match
+from TestBot.opendota.ratelimit import KeyPool, api_keys, retry_after, PARSE, WATCH, BACKFILL
+from TestBot.opendota.singleflight import SingleFlight
+from TestBot.opendota.store import MatchStore
+from TestBot.opendota.watcher import AsyncWatcherRegistry, WatcherRegistry
 from TestBot.utils import get_logger
+from TestBot.exceptions import OpenDotaException
 
 ROOT = os.environ["ROOT"]
 logger = get_logger(dir=f"{ROOT}/data/logs", filename="Dota.log", level=logging.DEBUG)
 
-class AsyncDotaClient():
+# Connection pool and timeouts shared by every request of a client; connections to api.opendota.com are kept
+# alive between polls instead of paying for a new TCP connection and TLS handshake on each call
+CONNECT_TIMEOUT, READ_TIMEOUT = 10, 30
+MAX_CONNECTIONS = int(os.environ.get("OD_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE = int(os.environ.get("OD_MAX_KEEPALIVE", 20))
+KEEPALIVE_EXPIRY = 60
+
+# Columns of `players/{id}/matches` used when checking for a new match; `match_id` is always returned
+LATEST_FIELDS = ["start_time", "duration"]
+
+# Cache key parameters of projected matches; only these are kept in memory, full payloads are read from the store
+PROJECTED = {"projection": "pricing"}
+
+# Matches fetched at once by `get_matches`; throughput is further bounded by the rate limiter
+BULK_CONCURRENCY = 8
+
+# Retries: backoff doubles from `RETRY_BASE` up to `RETRY_CAP` seconds and stops once a call has used its budget
+MAX_ATTEMPTS = int(os.environ.get("OD_MAX_ATTEMPTS", 4))
+RETRY_BUDGET = float(os.environ.get("OD_RETRY_BUDGET", 30))
+RETRY_BASE, RETRY_CAP = 0.5, 8
+# Hedging: a duplicate GET is sent once a request has taken longer than the endpoint's p95 latency
+HEDGE = os.environ.get("OD_HEDGE", "1") == "1"
+LATENCY_WINDOW, HEDGE_MIN_SAMPLES, HEDGE_MIN_DELAY = 200, 20, 0.25
+# Seconds between `RequestStats` reports in `Dota.log`
+REPORT_INTERVAL = 60
+
+# Parse job status polling: first delay, growth per poll and cap, in seconds; each delay is jittered down to half
+JOB_POLL_INITIAL, JOB_POLL_BACKOFF, JOB_POLL_MAX = 3, 1.5, 30
+
+class RequestStats:
+    """Counters for every GET made by a client, and recent latencies per endpoint for hedging."""
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.latency = 0.0
+        self.latencies: Dict[str, deque] = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def record(self, endpoint: str, latency: float) -> None:
+        self.requests += 1
+        self.latency += latency
+        self.latencies[endpoint].append(latency)
+
+    def hedge_delay(self, endpoint: str) -> float:
+        # p95 latency of the endpoint; None until enough requests have been seen
+        samples = self.latencies[endpoint]
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return max(HEDGE_MIN_DELAY, sorted(samples)[int(0.95 * (len(samples) - 1))])
+
+    def snapshot(self) -> Dict:
+        return {"requests": self.requests, "retries": self.retries, "rate_limited": self.rate_limited, "failures": self.failures,
+                "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                "latency_mean": self.latency / self.requests if self.requests else 0.0}
 
-    def __init__(self, api_key: str):
-        self.api_key = api_key
+class AsyncDotaClient():
+    """OpenDota client shared by the bot, the bet workers and `stream.py`; `SyncDotaClient` wraps it for blocking callers.
+
+    Every GET goes through `_request`, which waits on the shared rate limiter, retries and records `stats`.
+    """
+
+    def __init__(self, api_key: Union[str, List[str]], limits: httpx.Limits = None, timeout: httpx.Timeout = None, keys: KeyPool = None,
+                 cache: ResponseCache = None, store: MatchStore = None, hedge: bool = HEDGE, max_attempts: int = MAX_ATTEMPTS,
+                 retry_budget: float = RETRY_BUDGET):
+        # One key or a pool of keys; each key's budget is shared with every other process calling OpenDota
+        self.keys = keys or KeyPool([api_key] if isinstance(api_key, str) else api_key)
+        self.hedge = hedge
+        self.max_attempts = max_attempts
+        self.retry_budget = retry_budget
+        self.cache = cache or ResponseCache()
+        self.store = store or MatchStore()
         self.base_url = "https://api.opendota.com/api/"
+        self.limits = limits or httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE,
+                                             keepalive_expiry=KEEPALIVE_EXPIRY)
+        self.timeout = timeout or httpx.Timeout(CONNECT_TIMEOUT, read=READ_TIMEOUT)
+        # Created lazily so the pool is opened inside the event loop that uses it
+        self._http = None
+        # Created lazily as the registry must be bound to the running event loop
+        self._watchers = None
+        # Concurrent parse requests for the same `match_id` share one request and polling loop
+        self._parses = SingleFlight()
+        self.stats = RequestStats()
+        self._last_report = time.time()
+
+    @property
+    def watchers(self) -> AsyncWatcherRegistry:
+        if self._watchers is None:
+            self._watchers = AsyncWatcherRegistry({"player": self.latest_match_player, "team": self.latest_match_team})
+        return self._watchers
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+        return self._http
+
+    async def aclose(self) -> None:
+        # Closes pooled connections; the pool is reopened if the client is used again
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     def format_api_url(self, query: str, api_key: str = None) -> str:
         if api_key:
@@ -24,22 +131,122 @@ class AsyncDotaClient():
         else:
             return f"{self.base_url}{query}"
     
-    async def get_json_data(self, query: str, params: Dict = None):
+    async def get_json_data(self, query: str, params: Dict = None, priority: int = WATCH):
+        found, data = self.cache.get(query, params)
+        if found:
+            return data
+        data = await self._request_json(query, params, priority)
+        self.cache.put(query, params, data)
+        return data
+
+    async def _request_json(self, query: str, params: Dict = None, priority: int = WATCH):
+        return loads(await self._request(query, params, priority))
+
+    async def _request(self, query: str, params: Dict = None, priority: int = WATCH, method: str = "GET") -> bytes:
+        # Response body, undecoded. Transport errors, 429s and 5xx responses are retried with capped, jittered
+        # exponential backoff while the call's retry budget lasts; raises `OpenDotaException` otherwise.
+        # Only GETs are hedged.
         url = self.format_api_url(query)
         
-        if not params:
-            params = {}
-        params["api_key"] = self.api_key 
+        params = dict(params or {})
         
-        RETRIES = 3
-        for _ in range(RETRIES):
+        deadline, error = time.time() + self.retry_budget, None
+        for attempt in range(self.max_attempts):
+            if attempt:
+                delay = min(RETRY_CAP, RETRY_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+                if time.time() + delay > deadline:
+                    break
+                self.stats.retries += 1
+                await asyncio.sleep(delay)
             try:
-                async with httpx.AsyncClient(timeout=httpx.Timeout(10, read=30.0)) as client:
-                    response = check_response(await client.get(url, params=params))
-                return response.json()
-            except (httpx.RequestError, Exception) as e:
-                await asyncio.sleep(5) 
-        logger.error(f"Error {str(e)} in `get_json_data`.", exc_info=True, extra={"id":0})
+                if method == "GET":
+                    response = await self._hedged_get(query, url, params, priority)
+                else:
+                    key = await self.keys.acquire_async(priority)
+                    response = await self._send(method, query.split("/")[0], url, params, key)
+            except httpx.RequestError as e:
+                error = OpenDotaException(query, reason=f"{type(e).__name__} {str(e)}")
+                continue
+            if response.status_code == 429:
+                # The key that was rate limited has already been cooled down by `_send`
+                self.stats.rate_limited += 1
+                error = OpenDotaException(query, 429, "rate limited")
+                continue
+            if response.status_code >= 500:
+                error = OpenDotaException(query, response.status_code, response.text[:200])
+                continue
+            if not 200 <= response.status_code < 300:
+                raise OpenDotaException(query, response.status_code, response.text[:200])
+            self._report()
+            return response.content
+        self.stats.failures += 1
+        logger.error(f"Error {str(error)} in `get_json_data`.", extra={"id":0})
+        raise error
+
+    def _report(self) -> None:
+        now = time.time()
+        if (now - self._last_report) < REPORT_INTERVAL:
+            return
+        self._last_report = now
+        stats = self.stats.snapshot()
+        logger.info(f"{stats['requests']} requests, {stats['retries']} retries, {stats['rate_limited']} rate limited, "
+                    f"{stats['failures']} failures; latency mean {stats['latency_mean']:.3f}s; "
+                    f"{stats['hedges']} hedges, {stats['hedge_wins']} won by the hedge.", extra={"id":"client"})
+        cache = ", ".join(f"{name} {counts['hits']}/{counts['misses']}/{counts['evictions']}" for name, counts in self.cache.stats().items())
+        logger.info(f"Cache hits/misses/evictions: {cache}.", extra={"id":"client"})
+        # Keys are logged by their sha1 id, never in full
+        for key, usage in self.keys.usage().items():
+            logger.info(f"Key {key}: {usage['requests']} requests, {usage['rate_limited']} rate limited; "
+                        f"{usage['minute']:.0f} left this minute, {usage['day']:.0f} today, blocked for {usage['blocked_for']:.0f}s.",
+                        extra={"id":"client"})
+
+    async def _send(self, method: str, endpoint: str, url: str, params: Dict, key: str) -> httpx.Response:
+        # `key` has already taken a token from the pool
+        start = time.time()
+        response = await self.http.request(method, url, params={**params, "api_key": key})
+        self.stats.record(endpoint, time.time() - start)
+        if response.status_code == 429:
+            # Every process stops using this key until `Retry-After` has passed
+            self.keys.penalise(key, retry_after(response.headers))
+        return response
+
+    async def _hedged_get(self, query: str, url: str, params: Dict, priority: int) -> httpx.Response:
+        # Sends a second identical GET if the first has not answered within the endpoint's p95 latency,
+        # and returns whichever response arrives first. Parse job polls are not hedged: they are repeated anyway.
+        endpoint = query.split("/")[0]
+        # Waits for the shared budget of the least used key rather than failing; the hedge delay only
+        # starts once the request holds a token, so time spent throttled never triggers a hedge
+        key = await self.keys.acquire_async(priority)
+        hedged = self.hedge and priority != BACKFILL and endpoint != "request"
+        delay = self.stats.hedge_delay(endpoint) if hedged else None
+        if delay is None:
+            return await self._send("GET", endpoint, url, params, key)
+        primary = asyncio.ensure_future(self._send("GET", endpoint, url, params, key))
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done:
+                return primary.result()
+            # Only hedge with a token that is free right now; waiting for one would add load while throttled
+            hedge_key, _ = self.keys.try_acquire(priority)
+            if hedge_key is None:
+                return await primary
+            self.stats.hedges += 1
+            hedge = asyncio.ensure_future(self._send("GET", endpoint, url, params, hedge_key))
+            tasks.add(hedge)
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.stats.hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
 
     async def health(self):
         try:
@@ -54,86 +261,126 @@ class AsyncDotaClient():
             return False
         return True
 
-    async def wait_new_id(self, player_id: int) -> int:
-        # Extract current `match_id`
-        latest_id = await self.latest_match_id(player_id)
-        status = False
-        # Wait for new `match_id`
-        while not status:
-            _id = await self.latest_match_id(player_id)
-            if _id != latest_id:
-                return _id
-            # sleep for 120; a long sleep improves rest of the code but increases latency
-            await asyncio.sleep(120)
-        logger.error(f"No new _id found in `wait_new_id`. Raising exception.", exc_info=True, extra={"id":0})
-        raise
-
-    async def parse_game(self, match_id: int) -> None:
+    async def wait_new_id_player(self, player_id: int, cmd_id: str, timeout: int = 80 * 60, baseline: int = None,
+                               on_subscribe: Callable[[int], None] = None, placed_at: float = None) -> int:
+        # Subscribes to the shared watcher for `player_id`; one poll serves every bet on the account
+        _id = await self.watchers.wait("player", player_id, cmd_id, timeout, baseline, on_subscribe, placed_at)
+        logger.debug(f"New id found: {_id}", extra={"id":cmd_id})
+        return _id
+
+    async def wait_new_id_team(self, team_id: int, cmd_id: str, timeout: int = 80 * 60, baseline: int = None,
+                               on_subscribe: Callable[[int], None] = None, placed_at: float = None) -> int:
+        # Subscribes to the shared watcher for `team_id`; one poll serves every bet on the team
+        _id = await self.watchers.wait("team", team_id, cmd_id, timeout, baseline, on_subscribe, placed_at)
+        logger.debug(f"New id found: {_id}", extra={"id":cmd_id})
+        return _id
+
+    async def parse_game(self, match_id: int, cmd_id: str = 0, projected: bool = False) -> Dict:
+        # Submits a parse job and polls its status, backing off with jitter; the match is fetched once the job is done
+        # Submitted like any other request, so 429s cool down the key and failures are retried and counted
+        job = loads(await self._request(f"request/{match_id}", priority=PARSE, method="POST")) or {}
+        job_id = (job.get("job") or {}).get("jobId")
+        logger.debug(f"Parse job {job_id} submitted for match {match_id}.", extra={"id":cmd_id})
+        delay = JOB_POLL_INITIAL
+        while job_id is not None:
+            await asyncio.sleep(random.uniform(delay / 2, delay))
+            # A job is returned while it is queued or running, and `null` once it has finished
+            if await self._request_json(f"request/{job_id}", priority=PARSE) is None:
+                break
+            delay = min(JOB_POLL_MAX, delay * JOB_POLL_BACKOFF)
+        return await self.get_match(match_id, projected=projected)
+
+    async def parse_match_get_data(self, match_id: int, cmd_id: str = 0, projected: bool = False) -> Dict:
+        # Every caller receives the same match dict, which must therefore be treated as read-only
+        if self._parses.in_flight((match_id, projected)):
+            logger.debug(f"Joining in-flight parse of match {match_id}.", extra={"id":cmd_id})
+        return await self._parses.do((match_id, projected), lambda: self._parse_match_get_data(match_id, cmd_id, projected))
+
+    async def _parse_match_get_data(self, match_id: int, cmd_id: str = 0, projected: bool = False) -> Dict:
+        MAX_RETRIES, RETRY_DELAY = 8, 5
+        # Check if the game is already parsed, locally or on OpenDota; a parse is only requested if it is not
         try:
-            # post request
-            query = f"request/{match_id}"
-            url = self.format_api_url(query, self.api_key)
-            check_response(requests.post(url))
-            
-            # async check to see if parse has completed
-            status = True
-            while status:
-                if await self.is_parsed(match_id):
-                    status = False
-                else:
-                    await asyncio.sleep(60)
-        except Exception as e:
-            logger.error(f"Error {str(e)} in `parse_game`.", exc_info=True, extra={"id":0})
+            match_data = await self.get_match(match_id, projected=projected)
+        except OpenDotaException as e:
+            logger.warning(f"Could not check whether match {match_id} is parsed: {str(e)}", extra={"id":cmd_id})
+            match_data = None
+        if match_data and match_data.get("radiant_xp_adv"):
+            logger.info(f"Match {match_id} is already parsed.", extra={"id":cmd_id})
+            return match_data
 
-    async def parse_match_get_data(self, match_id: int) -> Dict:
-        MAX_RETRIES, RETRY_DELAY = 5, 5
         for attempt in range(1, MAX_RETRIES + 1):
             try:
-                # Check if the game is already parsed
-                if await self.is_parsed(match_id):
-                    logger.info(f"Match {match_id} is already parsed. Retrieving data...", extra={"id":0})
-                    match_data = await asyncio.wait_for(self.get_match(match_id), timeout=60)
-                    return match_data
-
-                # If not parsed, try parsing it
-                logger.info(f"Match {match_id} is not parsed. Attempting parse (Attempt {attempt}/{MAX_RETRIES})...", extra={"id":0})
-                await asyncio.wait_for(self.parse_game(match_id), timeout=220)
-
-                # After parsing, retrieve the game data
-                # Add sleep to allow the OpenDota server time to adjust 
-                await asyncio.sleep(20)
-                match_data = await asyncio.wait_for(self.get_match(match_id), timeout=30)
+                logger.info(f"Requesting parse of match {match_id} (Attempt {attempt}/{MAX_RETRIES})...", extra={"id":cmd_id})
+                match_data = await asyncio.wait_for(self.parse_game(match_id, cmd_id, projected), timeout=220)
                 
-                if not match_data["radiant_xp_adv"]:
-                    logger.warning(f"Match data for {match_id} is empty or invalid. Retrying...", extra={"id":0})
+                if not match_data or not match_data["radiant_xp_adv"]:
+                    logger.warning(f"Match data for {match_id} is empty or invalid. Retrying...", extra={"id":cmd_id})
+                    await asyncio.sleep(RETRY_DELAY)
                     continue
 
                 return match_data
 
             except asyncio.TimeoutError:
-                logger.warning(f"Timeout error on attempt {attempt} for match_id {match_id}.", extra={"id":0})
+                logger.warning(f"Timeout error on attempt {attempt} for match_id {match_id}.", extra={"id":cmd_id})
                 if attempt < MAX_RETRIES:
                     await asyncio.sleep(RETRY_DELAY)
                 else:
-                    logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts due to timeouts.", extra={"id":0})
+                    logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts due to timeouts.", extra={"id":cmd_id})
                     raise 
 
             except Exception as e:
-                logger.warning(f"Error while trying to retrieve match data for match_id {match_id} on attempt {attempt}: {str(e)}", extra={"id":0})
+                logger.warning(f"Error while trying to retrieve match data for match_id {match_id} on attempt {attempt}: {str(e)}", extra={"id":cmd_id})
                 if attempt < MAX_RETRIES:
                     await asyncio.sleep(RETRY_DELAY)
                 else:
-                    logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":0})
+                    logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":cmd_id})
                     raise
 
-        logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":0})
+        logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":cmd_id})
         raise ValueError(f"Failed to retrieve match data for match_id {match_id}.")
 
-    async def get_match(self, match_id: int) -> Dict:
-        query = f"matches/{match_id}"
-        data = await self.get_json_data(query)
+    async def cached_match(self, match_id: int, projected: bool = False) -> Dict:
+        # The match from the memory cache or the on-disk store, or None; both only ever hold parsed matches
+        query, params = f"matches/{match_id}", PROJECTED if projected else None
+        found, data = self.cache.get(query, params)
+        if found:
+            return data
+        raw = await asyncio.get_running_loop().run_in_executor(None, self.store.get_raw, match_id)
+        if raw is None:
+            return None
+        data = project_match(loads(raw)) if projected else loads(raw)
+        self.cache.put(query, params, data)
+        return data
+
+    async def get_match(self, match_id: int, priority: int = PARSE, projected: bool = False) -> Dict:
+        # Memory cache, then the on-disk store, then the API; parsed matches are written to the store in full.
+        # `projected` returns only the fields used for pricing (see `project_match`).
+        data = await self.cached_match(match_id, projected)
+        if data is None:
+            raw = await self._request(f"matches/{match_id}", priority=priority)
+            data = loads(raw)
+            await asyncio.get_running_loop().run_in_executor(None, self.store.put, data, raw)
+            if projected:
+                data = project_match(data)
+            self.cache.put(f"matches/{match_id}", PROJECTED if projected else None, data)
         return data
     
+    async def get_matches(self, match_ids: List[int], concurrency: int = BULK_CONCURRENCY, priority: int = PARSE,
+                          projected: bool = False) -> List[Dict]:
+        # Fetches many matches at once, at most `concurrency` in flight; results are in the order of `match_ids`,
+        # with None for any match that could not be fetched
+        slots = asyncio.Semaphore(concurrency)
+
+        async def fetch(match_id: int) -> Dict:
+            async with slots:
+                try:
+                    return await self.get_match(match_id, priority, projected)
+                except Exception as e:
+                    logger.warning(f"Error {str(e)} fetching match {match_id}.", extra={"id":"NULL"})
+                    return None
+
+        return await asyncio.gather(*(fetch(match_id) for match_id in match_ids))
+
     async def get_recent_id(self) -> str:
         data = await self.get_json_data("live")
         return data[0]["match_id"]
@@ -144,194 +391,133 @@ class AsyncDotaClient():
         sorted_ids = [d["id"] for d in sorted(data, key=lambda x: x["date"])]
         return sorted_ids[-1]
     
-    async def get_matches_by_player(self, player_id: int, limit: int=None) -> List[Dict]:
+    async def get_matches_by_player(self, player_id: int, limit: int=None, fields: List[str] = None) -> List[Dict]:
+        # `limit` and `fields` are applied by the API, so only the requested rows and columns are sent
         query = f"players/{player_id}/matches"
+        params = {}
+        if limit:
+            params["limit"] = limit
+        if fields:
+            params["project"] = fields
+        return await self.get_json_data(query, params)
+    
+    async def get_matches_by_team(self, team_id: int, limit: int=None) -> List[Dict]:
+        query = f"teams/{team_id}/matches"
         data = await self.get_json_data(query)
         if limit:
             return data[:limit]
         else:
             return data
-    
-    async def latest_match_id(self, player_id: int) -> Dict:
-        matches = await self.get_matches_by_player(player_id)
-        return matches[0]['match_id']
+
+    async def latest_match_player(self, player_id: int) -> Dict:
+        # Newest row only, with the columns the poll scheduler needs
+        matches = await self.get_matches_by_player(player_id, limit=1, fields=LATEST_FIELDS)
+        return matches[0]
+
+    async def latest_match_team(self, team_id: int) -> Dict:
+        # `teams/{id}/matches` takes no `limit`; team histories are short enough to fetch whole
+        matches = await self.get_matches_by_team(team_id)
+        return matches[0]
+
+    async def latest_match_id_player(self, player_id: int) -> Dict:
+        match = await self.latest_match_player(player_id)
+        return match['match_id']
+
+    async def latest_match_id_team(self, team_id: int) -> Dict:
+        match = await self.latest_match_team(team_id)
+        return match['match_id']
     
 
 class SyncDotaClient:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        self.base_url = "https://api.opendota.com/api/"
+    """Blocking facade over `AsyncDotaClient`.
 
-    def format_api_url(self, query: str, api_key: str = None) -> str:
-        if api_key:
-            return f"{self.base_url}{query}?api_key={api_key}"
-        else:
-            return f"{self.base_url}{query}"
+    The async client runs on a private event loop in a daemon thread and every method submits a coroutine to
+    it and waits for the result, so both clients share one transport, retry policy, cache and rate limit.
+    Match watching stays thread-based: `WatcherRegistry` polls through this facade.
+    """
+    def __init__(self, api_key: Union[str, List[str]], **kwargs):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="opendota-loop", daemon=True)
+        self._thread.start()
+        # `kwargs` are passed on to `AsyncDotaClient`, e.g. `limits`, `timeout`, `keys`, `cache` and `store`
+        self.client = AsyncDotaClient(api_key, **kwargs)
+        self.watchers = WatcherRegistry({"player": self.latest_match_player, "team": self.latest_match_team})
+
+    def _run(self, coro: Awaitable, timeout: float = None):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result(timeout)
+
+    @property
+    def stats(self) -> "RequestStats":
+        return self.client.stats
+
+    def key_usage(self) -> Dict[str, Dict]:
+        return self.client.keys.usage()
+
+    def close(self) -> None:
+        self._run(self.client.aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def get_json_data(self, query: str, params: Dict = None, priority: int = WATCH):
+        return self._run(self.client.get_json_data(query, params, priority))
+
+    def health(self):
+        return self._run(self.client.health())
 
-    def get_json_data(self, query: str, params: Dict = None):
-        url = self.format_api_url(query)
-        
-        if not params:
-            params = {}
-        params["api_key"] = self.api_key 
-        
-        RETRIES = 3
-        for _ in range(RETRIES):
-            try:
-                response = check_response(requests.get(url, params = params))
-                return response.json()
-            except Exception as e:
-                time.sleep(5)
-                #logger.error(f"Error {str(e)} in `get_json_data`.", exc_info=True, extra={"id":cmd_id})
-    
     def is_parsed(self, match_id: int) -> bool:
-        data = self.get_match(match_id)
-        # check if the xp/gold data is valid
-        if (data['radiant_xp_adv'] is None) & (data['radiant_gold_adv'] is None):
-            return False
-        return True
+        return self._run(self.client.is_parsed(match_id))
 
-    def wait_new_id_player(self, player_id: int, cmd_id: str, timeout: int = 80 * 60) -> int:
-        # init timer
-        start_time = time.time()
-        # Extract current `match_id`
-        latest_id = self.latest_match_id_player(player_id)
-        status = False
-        # Wait for new `match_id`
-        while not status:
-            if (time.time() - start_time) > timeout:
-                raise TimeoutError
-            _id = self.latest_match_id_player(player_id)
-            if _id != latest_id:
-                logger.debug(f"New id found: {_id}", extra={"id":cmd_id})
-                return _id
-            # sleep for 120; a long sleep improves rest of the code but increases latency
-            time.sleep(120)
-        logger.error(f"No new _id found in `wait_new_id_player`. Raising exception.", exc_info=True, extra={"id":cmd_id})
-        raise Exception
-
-    def wait_new_id_team(self, team_id: int, cmd_id: str, timeout: int = 80 * 60) -> int:
-        # init timer
-        start_time = time.time()
-        # Extract current `match_id`
-        latest_id = self.latest_match_id_team(team_id)
-        status = False
-        # Wait for new `match_id`
-        while not status:
-            if (time.time() - start_time) > timeout:
-                raise TimeoutError
-            _id = self.latest_match_id_team(team_id)
-            if _id != latest_id:
-                logger.debug(f"New id found: {_id}", extra={"id":cmd_id})
-                return _id
-            # sleep for 120; a long sleep improves rest of the code but increases latency
-            time.sleep(30)
-        logger.error(f"No new _id found in `wait_new_id_team`. Raising exception.", exc_info=True, extra={"id":cmd_id})
-        raise Exception
-
-    def parse_game(self, match_id: int, timeout: int = 180) -> None:
-        # post request
-        query = f"request/{match_id}"
-        url = self.format_api_url(query, self.api_key)
-        check_response(requests.post(url))
-        
-        # async check to see if parse has completed
-        status = True
-        # init timer
-        start_time = time.time()
-        while status:
-            if (time.time() - start_time) > timeout:
-                raise TimeoutError
-            if self.is_parsed(match_id):
-                status = False
-            else:
-                time.sleep(20)
-
-    def parse_match_get_data(self, match_id: int, cmd_id: str) -> Dict:
-        MAX_RETRIES, RETRY_DELAY = 8, 5
+    def wait_new_id_player(self, player_id: int, cmd_id: str, timeout: int = 80 * 60, placed_at: float = None) -> int:
+        # Subscribes to the shared watcher for `player_id`; one poll serves every bet on the account
+        _id = self.watchers.wait("player", player_id, cmd_id, timeout, placed_at)
+        logger.debug(f"New id found: {_id}", extra={"id":cmd_id})
+        return _id
 
-        for attempt in range(1, MAX_RETRIES + 1):
-            try:
-                # Check if the game is already parsed
-                if self.is_parsed(match_id):
-                    logger.info(f"Match {match_id} is already parsed. Retrieving data...", extra={"id":cmd_id})
-                    match_data = self.get_match(match_id)
-                    return match_data
-
-                # If not parsed, try parsing it
-                logger.info(f"Match {match_id} is not parsed. Attempting parse (Attempt {attempt}/{MAX_RETRIES})...", extra={"id":cmd_id})
-                self.parse_game(match_id)
-
-                # After parsing, retrieve the game data
-                # Add sleep to allow the OpenDota server time to adjust 
-                time.sleep(20)
-                match_data = self.get_match(match_id)
-                
-                if not match_data["radiant_xp_adv"]:
-                    logger.warning(f"Match data for {match_id} is empty or invalid. Retrying...", extra={"id":cmd_id})
-                    continue
+    def wait_new_id_team(self, team_id: int, cmd_id: str, timeout: int = 80 * 60, placed_at: float = None) -> int:
+        # Subscribes to the shared watcher for `team_id`; one poll serves every bet on the team
+        _id = self.watchers.wait("team", team_id, cmd_id, timeout, placed_at)
+        logger.debug(f"New id found: {_id}", extra={"id":cmd_id})
+        return _id
 
-                return match_data
+    def parse_game(self, match_id: int, timeout: int = 180, projected: bool = False) -> Dict:
+        return self._run(asyncio.wait_for(self.client.parse_game(match_id, projected=projected), timeout))
 
-            except TimeoutError as e:
-                logger.warning(f"Error while trying to retrieve match data for match_id {match_id} on attempt {attempt}: {str(e)}", extra={"id":cmd_id})
-                if attempt < MAX_RETRIES:
-                    time.sleep(RETRY_DELAY)
-                else:
-                    logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":cmd_id})
-                    raise
-            
-            except Exception as e:
-                logger.warning(f"Error while trying to retrieve match data for match_id {match_id} on attempt {attempt}: {str(e)}", extra={"id":cmd_id})
-                if attempt < MAX_RETRIES:
-                    time.sleep(RETRY_DELAY)
-                else:
-                    logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":cmd_id})
-                    raise
+    def parse_match_get_data(self, match_id: int, cmd_id: str, projected: bool = False) -> Dict:
+        return self._run(self.client.parse_match_get_data(match_id, cmd_id, projected))
 
-        logger.error(f"Failed to retrieve match data for match_id {match_id} after {MAX_RETRIES} attempts.", extra={"id":cmd_id})
-        raise ValueError(f"Failed to retrieve match data for match_id {match_id}.")
+    def cached_match(self, match_id: int, projected: bool = False) -> Dict:
+        return self._run(self.client.cached_match(match_id, projected))
 
-    def get_match(self, match_id: int) -> Dict:
-        query = f"matches/{match_id}"
-        data = self.get_json_data(query)
-        return data
+    def get_match(self, match_id: int, priority: int = PARSE, projected: bool = False) -> Dict:
+        return self._run(self.client.get_match(match_id, priority, projected))
+
+    def get_matches(self, match_ids: List[int], concurrency: int = BULK_CONCURRENCY, priority: int = PARSE,
+                    projected: bool = False) -> List[Dict]:
+        return self._run(self.client.get_matches(match_ids, concurrency, priority, projected))
 
     def get_recent_id(self) -> str:
-        data = self.get_json_data("live")
-        return data[0]["match_id"]
+        return self._run(self.client.get_recent_id())
+
+    def get_current_patch(self) -> int:
+        return self._run(self.client.get_current_patch())
+
+    def get_matches_by_player(self, player_id: int, limit: int=None, fields: List[str] = None) -> List[Dict]:
+        return self._run(self.client.get_matches_by_player(player_id, limit, fields))
 
-    def get_matches_by_player(self, player_id: int, limit: int=None) -> List[Dict]:
-        query = f"players/{player_id}/matches"
-        data = self.get_json_data(query)
-        if limit:
-            return data[:limit]
-        else:
-            return data
-        
     def get_matches_by_team(self, team_id: int, limit: int=None) -> List[Dict]:
-        query = f"teams/{team_id}/matches"
-        data = self.get_json_data(query)
-        if limit:
-            return data[:limit]
-        else:
-            return data
+        return self._run(self.client.get_matches_by_team(team_id, limit))
+
+    def latest_match_player(self, player_id: int) -> Dict:
+        return self._run(self.client.latest_match_player(player_id))
+
+    def latest_match_team(self, team_id: int) -> Dict:
+        return self._run(self.client.latest_match_team(team_id))
 
     def latest_match_id_player(self, player_id: int) -> Dict:
-        matches = self.get_matches_by_player(player_id)
-        return matches[0]['match_id']
+        return self.latest_match_player(player_id)['match_id']
 
     def latest_match_id_team(self, team_id: int) -> Dict:
-        matches = self.get_matches_by_team(team_id)
-        return matches[0]['match_id']
-    
-    def health(self):
-        try:
-            return self.get_json_data("health")
-        except Exception as e:
-            logger.error(f"Error {str(e)} in `health`.")
+        return self.latest_match_team(team_id)['match_id']
     
 if __name__=="__main__":
-    api_key = os.environ["OD_API_KEY"]
-    sda = SyncDotaClient(api_key=api_key)
-    ada = AsyncDotaClient(api_key=api_key)
\ No newline at end of file
+    sda = SyncDotaClient(api_key=api_keys())
+    ada = AsyncDotaClient(api_key=api_keys())
\ No newline at end of file
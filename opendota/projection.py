@@ -0,0 +1,54 @@
+from array import array
+import json
+from typing import Dict, List, Optional
+
+# orjson decodes match payloads several times faster than the standard library when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Fields of a match used by pricing, plotting and `GameParser.parse`
+MATCH_FIELDS = ("match_id", "start_time", "duration", "lobby_type", "radiant_win", "patch")
+PLAYER_FIELDS = ("player_slot", "account_id", "isRadiant", "hero_id", "lane")
+# Per-minute series, stored as compact arrays rather than lists of Python ints
+SERIES_FIELDS = ("lh_t", "xp_t", "gold_t")
+ADVANTAGE_FIELDS = ("radiant_xp_adv", "radiant_gold_adv")
+
+def series(values: Optional[List]) -> Optional[array]:
+    if values is None:
+        return None
+    try:
+        return array("i", values)
+    except (TypeError, OverflowError):
+        return array("d", values)
+
+def project_match(match: Dict) -> Dict:
+    """Keeps only the fields pricing needs from a full `matches/{id}` payload.
+
+    Chat, logs, purchases and the other per-player breakdowns are dropped, objectives are reduced to
+    building kills and the per-minute series become `array`s, which are indexable like lists and convert
+    directly with `np.array`. The result is read-only and is not written back to the match store.
+
+    The payload is still decoded in full first: neither orjson nor `json` can decode only some fields,
+    and skipping the others with a Python-level scanner would be slower than decoding them. What the
+    projection saves is memory, as only the projected match is kept in the response cache.
+    """
+    if not match:
+        return match
+    projected = {field: match.get(field) for field in MATCH_FIELDS}
+    for field in ADVANTAGE_FIELDS:
+        projected[field] = series(match.get(field))
+    if match.get("radiant_team"):
+        projected["radiant_team"] = {"team_id": match["radiant_team"].get("team_id")}
+    projected["objectives"] = [{"time": o["time"], "type": o["type"], "key": o.get("key", "")}
+                               for o in match.get("objectives") or [] if o.get("type") == "building_kill"]
+    players = []
+    for player in match.get("players") or []:
+        compact = {field: player.get(field) for field in PLAYER_FIELDS}
+        for field in SERIES_FIELDS:
+            compact[field] = series(player.get(field))
+        players.append(compact)
+    projected["players"] = players
+    return projected
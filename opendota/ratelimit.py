@@ -0,0 +1,213 @@
+import asyncio
+from collections import defaultdict
+import datetime
+from email.utils import parsedate_to_datetime
+import fcntl
+import hashlib
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.environ["ROOT"]
+RATELIMIT_FILE = f"{ROOT}/data/ratelimit.bin"
+RATELIMIT_DIR = f"{ROOT}/data"
+
+# OpenDota budget of each key; a per-day limit of 0 means no daily cap
+PER_MINUTE = int(os.environ.get("OD_RATE_PER_MINUTE", 1200))
+PER_DAY = int(os.environ.get("OD_RATE_PER_DAY", 0))
+
+# Priorities, highest first. Settling a bet needs its parse, watcher polls decide when bets settle,
+# and stream backfill can always wait.
+PARSE, WATCH, BACKFILL = 0, 1, 2
+# Fraction of the budget a priority must leave untouched for the ones above it
+RESERVES = {PARSE: 0.0, WATCH: 0.1, BACKFILL: 0.5}
+
+# tokens, last refill, UTC day ordinal, requests made that day, no requests until
+_STATE = struct.Struct("ddqqd")
+
+class RateLimiter:
+    """Token bucket shared by every process using the OpenDota API on this host.
+
+    The bucket lives in a small file guarded by `fcntl.flock`, so the bot, each bet worker and `stream.py`
+    draw from the same budget of `per_minute` requests (refilled continuously) and `per_day` requests.
+    A priority may only take a token while more than its share of `reserves` is left. After a `429` the
+    server's `Retry-After` is recorded with `penalise` and every process holds off until it has passed.
+    """
+    def __init__(self, path: str = RATELIMIT_FILE, per_minute: int = PER_MINUTE, per_day: int = PER_DAY,
+                 reserves: Dict[int, float] = None):
+        self.path = path
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.per_day = per_day
+        self.reserves = reserves or RESERVES
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self) -> int:
+        # flock is held per open file, and a forked child would share its parent's; open once per process.
+        # Threads of one process share the file, so they are serialised by `_lock` as well.
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+        return self._fd
+
+    def _update(self, fn):
+        # Runs `fn(state, now) -> (state, result)` under the file lock
+        fd = self._open()
+        with self._lock:
+            return self._locked_update(fd, fn)
+
+    def _locked_update(self, fd: int, fn):
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            now = time.time()
+            raw = os.pread(fd, _STATE.size, 0)
+            if len(raw) == _STATE.size:
+                tokens, updated, day, day_count, blocked_until = _STATE.unpack(raw)
+                tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            else:
+                tokens, day, day_count, blocked_until = self.capacity, 0, 0, 0.0
+            today = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).toordinal()
+            if day != today:
+                day, day_count = today, 0
+            state, result = fn([tokens, day, day_count, blocked_until], now)
+            os.pwrite(fd, _STATE.pack(state[0], now, state[1], state[2], state[3]), 0)
+            return result
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _seconds_to_midnight(self, now: float) -> float:
+        tomorrow = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).date() + datetime.timedelta(days=1)
+        return datetime.datetime(tomorrow.year, tomorrow.month, tomorrow.day, tzinfo=datetime.timezone.utc).timestamp() - now
+
+    def try_acquire(self, priority: int = WATCH) -> float:
+        # Takes a token and returns 0, or returns the seconds to wait before trying again
+        reserve = self.reserves.get(priority, 0.0)
+
+        def take(state, now):
+            tokens, day, day_count, blocked_until = state
+            if blocked_until > now:
+                return state, blocked_until - now
+            if self.per_day and day_count + 1 > self.per_day * (1 - reserve):
+                return state, self._seconds_to_midnight(now)
+            floor = reserve * self.capacity
+            if tokens - 1 < floor:
+                return state, (floor + 1 - tokens) / self.rate
+            return [tokens - 1, day, day_count + 1, blocked_until], 0.0
+
+        return self._update(take)
+
+    def acquire(self, priority: int = WATCH) -> None:
+        while True:
+            wait = self.try_acquire(priority)
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, priority: int = WATCH) -> None:
+        while True:
+            wait = self.try_acquire(priority)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def penalise(self, retry_after: float) -> None:
+        # Called after a `429`; empties the bucket and blocks every process for `retry_after` seconds
+        def block(state, now):
+            return [0.0, state[1], state[2], max(state[3], now + retry_after)], None
+        self._update(block)
+
+    def remaining(self) -> Dict[str, float]:
+        def read(state, now):
+            tokens, _, day_count, blocked_until = state
+            return state, {"minute": tokens,
+                           "day": (self.per_day - day_count) if self.per_day else float("inf"),
+                           "blocked_for": max(0.0, blocked_until - now)}
+        return self._update(read)
+
+def retry_after(headers, default: float = 60) -> float:
+    # `Retry-After` may be given in seconds or as an HTTP date
+    value = headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+def api_keys() -> List[str]:
+    # `OD_API_KEYS` holds a comma-separated pool of keys; a single `OD_API_KEY` is used otherwise
+    keys = [key.strip() for key in os.environ.get("OD_API_KEYS", "").split(",") if key.strip()]
+    return keys or [os.environ["OD_API_KEY"]]
+
+def key_id(key: str) -> str:
+    # Names a key in files and reports without revealing it
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+class KeyPool:
+    """Spreads requests across several API keys, each with its own `RateLimiter` budget.
+
+    Every request takes a token from the key with the most headroom left (the smaller of its minute and day
+    budget), falling back to the next key if another process got there first. A key that receives a `429` is
+    cooled down for `Retry-After` in every process, while the other keys keep serving requests.
+    """
+    def __init__(self, keys: List[str], per_minute: int = PER_MINUTE, per_day: int = PER_DAY, reserves: Dict[int, float] = None,
+                 directory: str = RATELIMIT_DIR):
+        self.keys = list(keys)
+        self.limiters = {key: RateLimiter(os.path.join(directory, f"ratelimit-{key_id(key)}.bin"),
+                                          per_minute, per_day, reserves) for key in self.keys}
+        self.requests: Dict[str, int] = defaultdict(int)
+        self.rate_limited: Dict[str, int] = defaultdict(int)
+
+    def _headroom(self, key: str) -> float:
+        limiter = self.limiters[key]
+        remaining = limiter.remaining()
+        if remaining["blocked_for"]:
+            return -1.0
+        headroom = remaining["minute"] / limiter.capacity
+        if limiter.per_day:
+            headroom = min(headroom, remaining["day"] / limiter.per_day)
+        return headroom
+
+    def try_acquire(self, priority: int = WATCH) -> Tuple[Optional[str], float]:
+        # Returns (key, 0) with a token taken from `key`, or (None, seconds to wait)
+        ranked = self.keys if len(self.keys) == 1 else sorted(self.keys, key=self._headroom, reverse=True)
+        wait = float("inf")
+        for key in ranked:
+            key_wait = self.limiters[key].try_acquire(priority)
+            if not key_wait:
+                self.requests[key] += 1
+                return key, 0.0
+            wait = min(wait, key_wait)
+        return None, wait
+
+    def acquire(self, priority: int = WATCH) -> str:
+        while True:
+            key, wait = self.try_acquire(priority)
+            if key is not None:
+                return key
+            time.sleep(wait)
+
+    async def acquire_async(self, priority: int = WATCH) -> str:
+        while True:
+            key, wait = self.try_acquire(priority)
+            if key is not None:
+                return key
+            await asyncio.sleep(wait)
+
+    def penalise(self, key: str, retry_after: float) -> None:
+        self.rate_limited[key] += 1
+        self.limiters[key].penalise(retry_after)
+
+    def usage(self) -> Dict[str, Dict]:
+        # Requests and 429s seen by this process, and the budget left across all processes, per key
+        return {key_id(key): {"requests": self.requests[key], "rate_limited": self.rate_limited[key], **self.limiters[key].remaining()}
+                for key in self.keys}
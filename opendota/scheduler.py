@@ -0,0 +1,100 @@
+import bisect
+import json
+import os
+from statistics import NormalDist
+from typing import Dict, Iterable, List
+
+ROOT = os.environ["ROOT"]
+DURATIONS_FILE = f"{ROOT}/data/durations.json"
+
+MIN_INTERVAL, MAX_INTERVAL = 30, 600
+# Fraction of the remaining probability of the game ending that each poll should cover
+STEP = 0.15
+# Assumed time into the game when the bet is placed, used when the previous match does not bound the start
+ELAPSED_AT_BET = 10 * 60
+# Longest delay per watched kind while the start of the game is unknown; the bet may have been placed late in
+# the game, so polls stay as frequent as the fixed intervals used before the schedule
+UNBOUNDED_INTERVALS = {"player": 120, "team": 30}
+
+class MatchLengthDistribution:
+    """Empirical distribution of match durations in seconds."""
+    def __init__(self, durations: Iterable[int]):
+        self.durations: List[int] = sorted(durations)
+
+    @classmethod
+    def default(cls) -> "MatchLengthDistribution":
+        # Roughly matches public-match durations; used until `durations.json` has been built from our data
+        dist = NormalDist(mu=41 * 60, sigma=11 * 60)
+        return cls(max(10 * 60, int(dist.inv_cdf(q / 200))) for q in range(1, 200))
+
+    @classmethod
+    def load(cls, path: str = DURATIONS_FILE) -> "MatchLengthDistribution":
+        try:
+            with open(path, "r") as f:
+                durations = json.load(f)
+            if durations:
+                return cls(durations)
+        except (OSError, ValueError):
+            pass
+        return cls.default()
+
+    def survival(self, t: float) -> float:
+        # P(duration > t)
+        return 1 - bisect.bisect_right(self.durations, t) / len(self.durations)
+
+    def quantile(self, q: float) -> int:
+        ix = min(len(self.durations) - 1, max(0, int(q * len(self.durations))))
+        return self.durations[ix]
+
+class PollScheduler:
+    """Chooses the delay until the next poll for a new match.
+
+    The start of the current game is estimated from the end of the previous match (`start_time` + `duration`)
+    and the time the earliest bet was placed. Each delay then covers the same fraction `step` of the remaining
+    probability that the game has ended, so polls are rare early on and frequent around typical match lengths.
+    """
+    def __init__(self, distribution: MatchLengthDistribution = None, min_interval: int = MIN_INTERVAL,
+                 max_interval: int = MAX_INTERVAL, step: float = STEP, unbounded_intervals: Dict[str, int] = None):
+        self.distribution = distribution or MatchLengthDistribution.load()
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.step = step
+        self.unbounded_intervals = UNBOUNDED_INTERVALS if unbounded_intervals is None else unbounded_intervals
+
+    def bounded(self, last_match: Dict, placed_at: float) -> bool:
+        # Whether the end of the previous match, rather than `ELAPSED_AT_BET`, sets the estimated start
+        if not (last_match and last_match.get("start_time") and last_match.get("duration")):
+            return False
+        return last_match["start_time"] + last_match["duration"] >= placed_at - ELAPSED_AT_BET
+
+    def estimate_start(self, last_match: Dict, placed_at: float) -> float:
+        # A new game cannot start before the previous one ended; take the earliest plausible start
+        estimate = placed_at - ELAPSED_AT_BET
+        if last_match and last_match.get("start_time") and last_match.get("duration"):
+            estimate = max(estimate, last_match["start_time"] + last_match["duration"])
+        return estimate
+
+    def next_delay(self, last_match: Dict, placed_at: float, now: float, kind: str = None) -> float:
+        # `kind` is the watched kind, e.g. "player" or "team"; it caps the delay while the start is unknown
+        elapsed = now - self.estimate_start(last_match, placed_at)
+        remaining = self.distribution.survival(elapsed)
+        if remaining <= 0:
+            return self.min_interval
+        target = 1 - remaining * (1 - self.step)
+        delay = self.distribution.quantile(target) - elapsed
+        cap = self.max_interval
+        if not self.bounded(last_match, placed_at):
+            cap = min(cap, self.unbounded_intervals.get(kind, min(self.unbounded_intervals.values(), default=cap)))
+        return min(cap, max(self.min_interval, delay))
+
+def build_durations(games_path: str, out_path: str = DURATIONS_FILE) -> None:
+    # Builds `durations.json` from games written by `stream.py`; one minute per entry of `times`
+    durations = []
+    with open(games_path, "r") as f:
+        for line in f:
+            durations.append((len(json.loads(line)["times"]) - 1) * 60)
+    with open(out_path, "w") as f:
+        json.dump(durations, f)
+
+if __name__=="__main__":
+    build_durations(f"{ROOT}/data/games.json")
@@ -0,0 +1,87 @@
+import json
+import os
+import tempfile
+from typing import Dict, Iterator, Optional
+import zlib
+
+ROOT = os.environ["ROOT"]
+STORE_DIR = f"{ROOT}/data/matches"
+INDEX_FILE = "index.tsv"
+
+class MatchStore:
+    """zlib-compressed parsed matches on disk, one file per `match_id`.
+
+    Files are written to a temporary name and renamed into place, so readers in other processes only ever see
+    complete matches. Each new match appends one `match_id\\tstart_time\\tsize` line to the index with a
+    single `O_APPEND` write. Only parsed matches are stored as they no longer change.
+    """
+    def __init__(self, root: str = STORE_DIR, level: int = 6):
+        self.root = root
+        self.level = level
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, match_id: int) -> str:
+        # Spread files over 256 directories to keep directory listings short
+        return os.path.join(self.root, f"{int(match_id) % 256:02x}", f"{match_id}.json.z")
+
+    def has(self, match_id: int) -> bool:
+        return os.path.exists(self.path(match_id))
+
+    def get_raw(self, match_id: int) -> Optional[bytes]:
+        # The stored JSON document, undecoded
+        try:
+            with open(self.path(match_id), "rb") as f:
+                return zlib.decompress(f.read())
+        except FileNotFoundError:
+            return None
+
+    def get(self, match_id: int) -> Optional[Dict]:
+        raw = self.get_raw(match_id)
+        return json.loads(raw) if raw is not None else None
+
+    def put(self, match: Dict, raw: bytes = None) -> bool:
+        # `raw` is the response body `match` was decoded from; storing it saves re-encoding.
+        # Returns False for matches that are not parsed yet.
+        if not match or not match.get("radiant_xp_adv"):
+            return False
+        path = self.path(match["match_id"])
+        if os.path.exists(path):
+            return True
+        blob = zlib.compress(raw if raw is not None else json.dumps(match, separators=(",", ":")).encode(), self.level)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(blob)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        line = f"{match['match_id']}\t{match.get('start_time', 0)}\t{len(blob)}\n".encode()
+        fd = os.open(os.path.join(self.root, INDEX_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return True
+
+    def index(self) -> Dict[int, int]:
+        # `match_id` -> `start_time` of every stored match; matches written twice by racing processes appear once
+        index = {}
+        try:
+            with open(os.path.join(self.root, INDEX_FILE), "r") as f:
+                for line in f:
+                    fields = line.split("\t")
+                    if len(fields) == 3:
+                        index[int(fields[0])] = int(fields[1])
+        except FileNotFoundError:
+            pass
+        return index
+
+    def iter_matches(self, since: int = 0) -> Iterator[Dict]:
+        # Every stored match starting at or after `since`, oldest first; used for backtests and dataset building
+        for match_id, start_time in sorted(self.index().items(), key=lambda x: x[1]):
+            if start_time >= since:
+                match = self.get(match_id)
+                if match is not None:
+                    yield match
@@ -1,6 +1,6 @@
-from opendota.client import DotaAPIClient
-from opendota.parsing import GameParser
-import os 
+from TestBot.opendota.client import AsyncDotaClient
+from TestBot.opendota.parsing import GameParser
+from TestBot.opendota.ratelimit import BACKFILL, api_keys
 import queue
 import asyncio
 import json
@@ -16,20 +16,21 @@ LIMIT = 1e5
 ASYNC_SIGNAL = asyncio.Event()
 THREAD_SIGNAL = threading.Event()
 FILENAME = "./data/games.json"
+# Matches fetched concurrently by each `check_game` worker
+FETCH_CONCURRENCY = 4
 
-client = DotaAPIClient(os.environ["OD_API_KEY"])
+client = AsyncDotaClient(api_keys())
 
 async def stream_parsed_match_ids(init_id: str, q: asyncio.Queue):
     params = {"less_than_match_id":init_id}
     while not ASYNC_SIGNAL.is_set():
         try:
-            data = await client.get_json_data("parsedMatches", params=params)
+            data = await client.get_json_data("parsedMatches", params=params, priority=BACKFILL)
             if not data:
                 await asyncio.sleep(10)
                 continue
             _ids = [i["match_id"] for i in data]
-            for _id in _ids:
-                await q.put(_id)
+            await q.put(_ids)
             params["less_than_match_id"] = min(_ids)
         except:
             await asyncio.sleep(30)
@@ -39,19 +40,16 @@ async def stream_parsed_match_ids(init_id: str, q: asyncio.Queue):
 async def check_game(q: asyncio.Queue, output: queue.Queue):
     while not ASYNC_SIGNAL.is_set():
         try:
-            _id = await asyncio.wait_for(q.get(), timeout=2)
-            try:
-                _id = await asyncio.wait_for(q.get(), timeout=2)
-                data = await client.get_match(_id)
+            _ids = await asyncio.wait_for(q.get(), timeout=2)
+            matches = await client.get_matches(_ids, concurrency=FETCH_CONCURRENCY, priority=BACKFILL)
+            for data in matches:
+                if data is None:
+                    continue
                 if data["lobby_type"] not in [0,5,6,7]:
                     continue
                 if GameParser.check_early_finish(data):
                     continue
                 output.put(data)
-            except asyncio.TimeoutError:
-                await asyncio.sleep(20)
-            except Exception:
-                await asyncio.sleep(20)
         except asyncio.TimeoutError:
             await asyncio.sleep(20)
         except Exception:
@@ -145,6 +143,7 @@ async def main():
         for thread in process_data_threads:
             thread.join()
         write_to_file_thread.join()
+        await client.aclose()
 
 if __name__=="__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Hashable, Tuple
+
+from TestBot.opendota.scheduler import PollScheduler
+from TestBot.utils import get_logger
+
+ROOT = os.environ["ROOT"]
+logger = get_logger(dir=f"{ROOT}/data/logs", filename="Dota.log", level=logging.DEBUG)
+
+def finished_before(match: Dict, placed_at: float) -> bool:
+    # Whether `match` had already ended when a bet was placed; the watcher's baseline may be a poll delay old,
+    # so such a match is the bet's new baseline rather than the match it is waiting for
+    if not match or not match.get("start_time") or not match.get("duration"):
+        return False
+    return placed_at >= match["start_time"] + match["duration"]
+
+class Subscription:
+    def __init__(self, key: Tuple[str, int], cmd_id: str, baseline: int, placed_at: float):
+        self.key = key
+        self.cmd_id = cmd_id
+        self.baseline = baseline
+        self.placed_at = placed_at
+        self.match_id = None
+        self._event = threading.Event()
+
+    def notify(self, match_id: int) -> None:
+        self.match_id = match_id
+        self._event.set()
+
+    def wait(self, timeout: float) -> bool:
+        return self._event.wait(timeout)
+
+class MatchWatcher:
+    """Polls the latest match of a single Steam account or team on behalf of every subscribed bet.
+
+    `fetch_latest` returns the newest match row (`match_id`, `start_time`, `duration`). A single thread
+    polls it, sleeping for the delay chosen by the `PollScheduler`, and hands any new `match_id` to all
+    subscribers whose baseline differs from it. The thread exits once the last subscriber leaves.
+    """
+    def __init__(self, key: Tuple[str, int], fetch_latest: Callable[[int], Dict], registry: "WatcherRegistry"):
+        self.key = key
+        self.fetch_latest = fetch_latest
+        self.registry = registry
+        self.latest = fetch_latest(key[1])
+        self.subscribers: Dict[str, Subscription] = {}
+        self._thread = threading.Thread(target=self._poll, name=f"watch-{key[0]}-{key[1]}", daemon=True)
+
+    @property
+    def latest_id(self) -> int:
+        return self.latest["match_id"]
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _delay(self) -> float:
+        with self.registry.lock:
+            placed_at = min((sub.placed_at for sub in self.subscribers.values()), default=time.time())
+        return self.registry.scheduler.next_delay(self.latest, placed_at, time.time(), self.key[0])
+
+    def _publish(self, latest: Dict) -> None:
+        with self.registry.lock:
+            self.latest = latest
+            for sub in list(self.subscribers.values()):
+                if finished_before(latest, sub.placed_at):
+                    sub.baseline = latest["match_id"]
+                elif sub.baseline != latest["match_id"]:
+                    sub.notify(latest["match_id"])
+
+    def _poll(self) -> None:
+        while True:
+            time.sleep(self._delay())
+            if self.registry.retire_if_idle(self):
+                return
+            try:
+                latest = self.fetch_latest(self.key[1])
+            except Exception as e:
+                logger.warning(f"Error {str(e)} while polling {self.key[0]} {self.key[1]}.", extra={"id":"NULL"})
+                continue
+            if latest["match_id"] != self.latest_id:
+                logger.debug(f"New id found for {self.key[0]} {self.key[1]}: {latest['match_id']} ({len(self.subscribers)} subscribers)", extra={"id":"NULL"})
+                self._publish(latest)
+
+class WatcherRegistry:
+    """Keeps one `MatchWatcher` per (kind, id) and multiplexes every in-flight bet onto it.
+
+    `pollers` maps a kind, e.g. "player" or "team", to the function returning the newest match row for an id of that kind.
+    """
+    def __init__(self, pollers: Dict[str, Callable[[int], Dict]], scheduler: PollScheduler = None):
+        self.pollers = pollers
+        self.scheduler = scheduler or PollScheduler()
+        self.lock = threading.Lock()
+        self.watchers: Dict[Hashable, MatchWatcher] = {}
+
+    def subscribe(self, kind: str, target_id: int, cmd_id: str, placed_at: float = None) -> Subscription:
+        key = (kind, target_id)
+        placed_at = placed_at or time.time()
+        with self.lock:
+            watcher = self.watchers.get(key)
+            if watcher is not None:
+                sub = Subscription(key, cmd_id, watcher.latest_id, placed_at)
+                watcher.subscribers[cmd_id] = sub
+                return sub
+        # First subscriber for this target; fetch the baseline outside the lock
+        watcher = MatchWatcher(key, self.pollers[kind], self)
+        with self.lock:
+            existing = self.watchers.get(key)
+            if existing is not None:
+                # Another bet started a watcher while we were fetching
+                watcher = existing
+            else:
+                self.watchers[key] = watcher
+                watcher.start()
+            sub = Subscription(key, cmd_id, watcher.latest_id, placed_at)
+            watcher.subscribers[cmd_id] = sub
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        with self.lock:
+            watcher = self.watchers.get(sub.key)
+            if watcher is not None:
+                watcher.subscribers.pop(sub.cmd_id, None)
+
+    def retire_if_idle(self, watcher: MatchWatcher) -> bool:
+        # Called by the polling thread; removes the watcher once it has no subscribers left
+        with self.lock:
+            if watcher.subscribers:
+                return False
+            if self.watchers.get(watcher.key) is watcher:
+                del self.watchers[watcher.key]
+            return True
+
+    def wait(self, kind: str, target_id: int, cmd_id: str, timeout: int, placed_at: float = None) -> int:
+        sub = self.subscribe(kind, target_id, cmd_id, placed_at)
+        try:
+            if not sub.wait(timeout):
+                raise TimeoutError
+            return sub.match_id
+        finally:
+            self.unsubscribe(sub)
+
+class AsyncSubscription:
+    def __init__(self, key: Tuple[str, int], cmd_id: str, baseline: int, placed_at: float, future: asyncio.Future):
+        self.key = key
+        self.cmd_id = cmd_id
+        self.baseline = baseline
+        self.placed_at = placed_at
+        self.future = future
+
+    def notify(self, match_id: int) -> None:
+        if not self.future.done():
+            self.future.set_result(match_id)
+
+class AsyncMatchWatcher:
+    """Coroutine equivalent of `MatchWatcher`; a single task polls on behalf of every subscribed bet."""
+    def __init__(self, key: Tuple[str, int], fetch_latest: Callable[[int], Awaitable[Dict]], registry: "AsyncWatcherRegistry"):
+        self.key = key
+        self.fetch_latest = fetch_latest
+        self.registry = registry
+        self.latest = None
+        self.subscribers: Dict[str, AsyncSubscription] = {}
+        self.ready = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._poll())
+
+    @property
+    def latest_id(self) -> int:
+        return self.latest["match_id"]
+
+    def _delay(self) -> float:
+        placed_at = min((sub.placed_at for sub in self.subscribers.values()), default=time.time())
+        return self.registry.scheduler.next_delay(self.latest, placed_at, time.time(), self.key[0])
+
+    async def _poll(self) -> None:
+        # Fetch the baseline `match_id` before any subscriber can start waiting
+        try:
+            self.latest = await self.fetch_latest(self.key[1])
+            self.ready.set_result(self.latest_id)
+        except Exception as e:
+            self.registry.retire(self)
+            self.ready.set_exception(e)
+            return
+        while True:
+            await asyncio.sleep(self._delay())
+            if not self.subscribers:
+                self.registry.retire(self)
+                return
+            try:
+                latest = await self.fetch_latest(self.key[1])
+            except Exception as e:
+                logger.warning(f"Error {str(e)} while polling {self.key[0]} {self.key[1]}.", extra={"id":"NULL"})
+                continue
+            if latest["match_id"] != self.latest_id:
+                logger.debug(f"New id found for {self.key[0]} {self.key[1]}: {latest['match_id']} ({len(self.subscribers)} subscribers)", extra={"id":"NULL"})
+                self.latest = latest
+                for sub in list(self.subscribers.values()):
+                    if finished_before(latest, sub.placed_at):
+                        sub.baseline = latest["match_id"]
+                    elif sub.baseline != latest["match_id"]:
+                        sub.notify(latest["match_id"])
+
+class AsyncWatcherRegistry:
+    """Coroutine equivalent of `WatcherRegistry`; must be used from a single event loop."""
+    def __init__(self, pollers: Dict[str, Callable[[int], Awaitable[Dict]]], scheduler: PollScheduler = None):
+        self.pollers = pollers
+        self.scheduler = scheduler or PollScheduler()
+        self.watchers: Dict[Hashable, AsyncMatchWatcher] = {}
+
+    async def subscribe(self, kind: str, target_id: int, cmd_id: str, baseline: int = None, placed_at: float = None) -> AsyncSubscription:
+        # `baseline` resumes a subscription from a known `match_id`; by default the watcher's latest id is used
+        key = (kind, target_id)
+        watcher = self.watchers.get(key)
+        if watcher is None:
+            watcher = AsyncMatchWatcher(key, self.pollers[kind], self)
+            self.watchers[key] = watcher
+        await asyncio.shield(watcher.ready)
+        # `ready` holds the first id the watcher fetched; a new bet must wait for a match newer than the current one
+        sub = AsyncSubscription(key, cmd_id, watcher.latest_id if baseline is None else baseline, placed_at or time.time(),
+                                asyncio.get_running_loop().create_future())
+        watcher.subscribers[cmd_id] = sub
+        if watcher.latest_id != sub.baseline and not finished_before(watcher.latest, sub.placed_at):
+            # A new match was found while the subscriber was away
+            sub.notify(watcher.latest_id)
+        return sub
+
+    def unsubscribe(self, sub: AsyncSubscription) -> None:
+        watcher = self.watchers.get(sub.key)
+        if watcher is not None:
+            watcher.subscribers.pop(sub.cmd_id, None)
+
+    def retire(self, watcher: AsyncMatchWatcher) -> None:
+        if self.watchers.get(watcher.key) is watcher:
+            del self.watchers[watcher.key]
+
+    async def wait(self, kind: str, target_id: int, cmd_id: str, timeout: int, baseline: int = None,
+                   on_subscribe: Callable[[int], None] = None, placed_at: float = None) -> int:
+        # `on_subscribe` is called with the subscription's baseline `match_id` before waiting
+        sub = await self.subscribe(kind, target_id, cmd_id, baseline, placed_at)
+        if on_subscribe is not None:
+            on_subscribe(sub.baseline)
+        try:
+            return await asyncio.wait_for(sub.future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError
+        finally:
+            self.unsubscribe(sub)
@@ -1,18 +1,22 @@
-import asyncio
 import boto3
+from collections import OrderedDict
 from datetime import datetime
 from decimal import Decimal
+import hashlib
 import logging
 import numpy as np 
 import math
 import os
+import threading
 import time
-from typing import Dict, Tuple
-from xgboost import XGBClassifier
+from typing import Dict, List, Tuple, Union
+from xgboost import Booster, XGBClassifier
 
-from TestBot.opendota.client import SyncDotaClient, AsyncDotaClient
+from TestBot.opendota.client import SyncDotaClient
+from TestBot.opendota.ratelimit import api_keys
 from TestBot.opendota.parsing import GameParser
 from TestBot.exceptions import LobbyTypeException, BetTimeException
+from TestBot.features import FeatureBuilder, draft_view, stats_view, minutes
 from TestBot.utils import get_logger
 from TestBot.plotting import plot_game
 
@@ -21,6 +25,10 @@ ROOT = os.environ["ROOT"]
 MODEL_PATH = f"{ROOT}/model/"
 WEIGHTS1, WEIGHTS2 = "draft.json", "stats.json"
 WEIGHTS = "weights.json"
+# Per-minute P(Radiant win) curves kept in memory, keyed by match and model version
+CURVE_CACHE_SIZE = int(os.environ.get("CURVE_CACHE_SIZE", 256))
+# Predict with the raw boosters rather than the `XGBClassifier` wrappers; set to 0 to use `predict_proba`
+BOOSTER_INFERENCE = os.environ.get("BOOSTER_INFERENCE", "1") == "1"
 logger = get_logger(dir=f"{ROOT}/data/logs", filename="Pricing.log", level=logging.INFO)
 
 class Odds:
@@ -81,9 +89,15 @@ class PricingModel:
         self.s3 = aws.meta.client
         try:
             self.draft, self.stats = self._load_models()
+            self.draft_booster, self.stats_booster = self._load_boosters()
+            self.version = self._model_version()
         except:
             logger.error(f"Failed to retrieve model from AWS. Shutting down.")
             raise Exception
+        self.curves: "OrderedDict[Tuple, np.array]" = OrderedDict()
+        self.curves_lock = threading.Lock()
+        # Per-thread feature buffers, as pricing runs on an executor
+        self._features = threading.local()
 
     def _download_weights(self) -> None:
         MAX_RETRIES, RETRY_DELAY = 3, 5
@@ -108,6 +122,23 @@ class PricingModel:
         stats.load_model(os.path.join(MODEL_PATH, WEIGHTS2))
         return draft, stats
 
+    def _load_boosters(self) -> Tuple[Booster, Booster]:
+        # Thread settings are fixed once here instead of being reapplied by the wrapper on every call
+        boosters = []
+        for model in (self.draft, self.stats):
+            booster = model.get_booster()
+            booster.set_param({"nthread": 1})
+            boosters.append(booster)
+        return boosters[0], boosters[1]
+
+    def _model_version(self) -> str:
+        # Curves priced by one set of weights are never served once the weights change
+        digest = hashlib.sha1()
+        for name in (WEIGHTS1, WEIGHTS2):
+            with open(os.path.join(MODEL_PATH, name), "rb") as f:
+                digest.update(f.read())
+        return digest.hexdigest()[:12]
+
     def _bet_time(self, raw_game: Dict, bet_time: int) -> int:
         # Calculates the minute of the game; used to then index the stats
         bet_minute = math.ceil((bet_time - raw_game["start_time"]) / 60)
@@ -126,13 +157,40 @@ class PricingModel:
         else:
             return 0
 
-    def _json_to_array(self, parsed_game: Dict, time_index: int) -> np.array:
-        # Convert processed/parsed game data to numpy array 
-        player_stats = self._process_player_stats(parsed_game["players"], time_index)
-        time_val = parsed_game["times"][time_index]
-        X = np.concatenate([np.array([parsed_game["patch"]]), np.array([time_val]), player_stats])
-        return X.reshape(1, -1)
-    
+    def _builder(self) -> FeatureBuilder:
+        builder = getattr(self._features, "builder", None)
+        if builder is None:
+            builder = self._features.builder = FeatureBuilder()
+        return builder
+
+    def _win_curves(self, parsed_games: List[Dict]) -> List[np.array]:
+        # P(Radiant win) at every minute of each game. Cached curves are reused; the rest are predicted
+        # together with one call per model.
+        keys = [(game["match_id"], self.version, len(game["times"])) for game in parsed_games]
+        with self.curves_lock:
+            curves = [self.curves.get(key) for key in keys]
+        missing = [ix for ix, curve in enumerate(curves) if curve is None]
+        if missing:
+            probs = self._predict(self._builder().build_many([parsed_games[ix] for ix in missing]))
+            start = 0
+            for ix in missing:
+                curves[ix] = probs[start:start + minutes(parsed_games[ix])]
+                curves[ix].flags.writeable = False
+                start += len(curves[ix])
+        with self.curves_lock:
+            for ix in missing:
+                self.curves[keys[ix]] = curves[ix]
+            for key in keys:
+                if key in self.curves:
+                    self.curves.move_to_end(key)
+            while len(self.curves) > CURVE_CACHE_SIZE:
+                self.curves.popitem(last=False)
+        return curves
+
+    def win_curve(self, raw_game: Dict) -> np.array:
+        # Read-only P(Radiant win) for each minute of a parsed match; drives odds queries and plots
+        return self._win_curves([GameParser.parse(raw_game)])[0]
+
     def _team_prediction(self, raw_game: dict, args: dict) -> int:
         # Extracts the team of the player being bet on
         if "BeteeSteamID" in args.keys():
@@ -146,16 +204,6 @@ class PricingModel:
                 return 1
             return 0
 
-    def _process_player_stats(self, players: dict, time_index: int) -> np.array:
-        # Processing each players stats for the ML model 
-        radiant = sorted([players[key] for key in players.keys() if players[key]["team"]==1],key = lambda x: x["lane"])
-        dire = sorted([players[key] for key in players.keys() if players[key]["team"]==-1],key = lambda x: x["lane"])
-        radiant_heroes, dire_heroes = [i["hero_id"] for i in radiant], [i["hero_id"] for i in dire]
-        radiant_xp, dire_xp = [i["xp_t"][time_index] for i in radiant], [i["xp_t"][time_index] for i in dire]
-        radiant_lh, dire_lh = [i["lh_t"][time_index] for i in radiant], [i["lh_t"][time_index] for i in dire]
-        radiant_g, dire_g = [i["gold_t"][time_index] for i in radiant], [i["gold_t"][time_index] for i in dire]
-        return np.concatenate([radiant_heroes, radiant_xp, radiant_lh, radiant_g, dire_heroes, dire_xp, dire_lh, dire_g])
-
     def _check_bet_time(self, raw_game: Dict, bet_time: int) -> int:
         # Check if the bet_time is in a valid range
         if bet_time >= (raw_game["start_time"] - 60*5) and bet_time < (raw_game["start_time"] + raw_game["duration"]):
@@ -170,18 +218,6 @@ class PricingModel:
         if raw_game["lobby_type"] not in [0,1,2,5,6,7]:
             raise LobbyTypeException
 
-    def _process_game(self, raw_game: Dict, args: Dict, cmd_id: str) -> Tuple[int, Dict, np.array]:
-        # Validity Checks
-        self._check_lobby_type(raw_game)
-        args["Timestamp"] = self._check_bet_time(raw_game, args["Timestamp"])
-        
-        # Process data
-        processed_game = GameParser.parse(raw_game)
-        time_index = self._bet_time(raw_game, args["Timestamp"])
-
-        # Convert to array 
-        return time_index, processed_game, self._json_to_array(processed_game, time_index)
-    
     def _probability_transform(self, Rwin_prob: float, direction: int, team: int) -> float:
         # Converts the raw P(Radiant Win) from the model into the relevant prob based on the bet
         if (team == 1) and (direction == 1):
@@ -207,56 +243,102 @@ class PricingModel:
         radiant_gold_adv = (rad_gold - dire_gold)
         return radiant_xp_adv, radiant_gold_adv, "Radiant" if processed_game["radiant_win"] else "Dire"
 
-    def _draft_arr(self, X: np.array) -> np.array:
-        time, rad_h, dire_h = X[:,1], X[:,2:7], X[:, 22:27]
-        X_draft = np.concatenate([time.reshape(-1,1), rad_h, dire_h],axis=1)
-        return X_draft
-
-    def _stats_arr(self, X: np.array) -> np.array:
-        time, rad_stats, dire_stats = X[:,1].reshape(-1,1), X[:, 7:22], X[:, 27:]
-        X_stats = np.concatenate([time.reshape(-1,1), rad_stats, dire_stats],axis=1)
-        return X_stats
-
-    def _get_game_info(self, raw_game: Dict, args: Dict, cmd_id: str) -> Tuple[np.array, str, Dict, int]:
-        time, processed, X = self._process_game(raw_game, args, cmd_id)
-        team = self._team_prediction(raw_game, args)
-        return X, team, processed, time
-
     def _calculate_payout(self, raw_game: Dict, outcome: int, team: int, odds: Odds, bet_value: Decimal) -> Decimal:
         if not self._bet_outcome(raw_game, outcome, team):
             return 0
         return odds.payout(bet_value)
     
-    def calculate_odds(self, X: np.array, direction: int, team: int) -> Odds:
-        # Format arrays into model-specific arrays
-        Xd, Xs = self._draft_arr(X), self._stats_arr(X)
-        # Calculate probs from each model 
-        prob_d, prob_s = self.draft.predict_proba(Xd).flatten(), self.stats.predict_proba(Xs).flatten()
-        # Linear combination of model probabilities for prediction 
+    @staticmethod
+    def _iteration_range(model: XGBClassifier) -> Tuple[int, int]:
+        # `predict_proba` stops at the best iteration when the model was trained with early stopping
+        try:
+            return 0, model.best_iteration + 1
+        except AttributeError:
+            return 0, 0
+
+    def _predict(self, X: np.array) -> np.array:
+        if BOOSTER_INFERENCE:
+            return self._predict_booster(X)
+        return self._predict_sklearn(X)
+
+    def _predict_booster(self, X: np.array) -> np.array:
+        # Same result as `_predict_sklearn`: the float32 columns of `X` are predicted in place, skipping the
+        # wrapper's validation and DMatrix construction. The column views of `X` are strided, so each block
+        # is copied to a C-contiguous array as `inplace_predict` expects.
+        X = np.asarray(X, dtype=np.float32)
+        Xd, Xs = np.ascontiguousarray(draft_view(X)), np.ascontiguousarray(stats_view(X))
+        prob_d = self.draft_booster.inplace_predict(Xd, iteration_range=self._iteration_range(self.draft))
+        prob_s = self.stats_booster.inplace_predict(Xs, iteration_range=self._iteration_range(self.stats))
+        # P(Radiant Win) for each row
+        return prob_d * (0.6/(0.71 + 0.6)) + prob_s * (0.71/(0.71 + 0.6))
+
+    def _predict_sklearn(self, X: np.array) -> np.array:
+        # Columns used by each model
+        Xd, Xs = draft_view(X), stats_view(X)
+        # Calculate probs from each model; one call per model regardless of the number of rows
+        prob_d, prob_s = self.draft.predict_proba(Xd), self.stats.predict_proba(Xs)
+        # Linear combination of model probabilities for prediction
         raw_prob = prob_d * (0.6/(0.71 + 0.6)) + prob_s * (0.71/(0.71 + 0.6))
-        # Transform probabilities 
-        prob = self._probability_transform(raw_prob[1], direction, team)
-        # Produce odds
-        odds = Odds(prob)
-        return odds
-    
+        # P(Radiant Win) for each row
+        return raw_prob[:, 1]
+
+    def price_group(self, raw_game: Dict, bets: List[Tuple[Dict, str]]) -> List[Union[Tuple[Odds, Decimal], Exception]]:
+        # Prices every bet on one match; failures that apply to the whole match (e.g. `LobbyTypeException`) are raised
+        self._check_lobby_type(raw_game)
+        return self.price_batch([(raw_game, args, cmd_id) for args, cmd_id in bets])
+
+    def price_batch(self, bets: List[Tuple[Dict, Dict, str]], plot: bool = True) -> List[Union[Tuple[Odds, Decimal], Exception]]:
+        # Prices many (raw_game, args, cmd_id) bets, possibly on different matches. Each match is parsed once and
+        # priced from its cached win-probability curve, so a bet is an array lookup. Returns (odds, payout) for
+        # each bet, or the exception raised while pricing it. `plot=False` skips the per-bet plots, e.g. for backtests.
+        results: List = [None] * len(bets)
+        games: Dict[int, Dict] = {}
+        for ix, (raw_game, args, cmd_id) in enumerate(bets):
+            try:
+                if raw_game["match_id"] not in games:
+                    self._check_lobby_type(raw_game)
+                    games[raw_game["match_id"]] = GameParser.parse(raw_game)
+            except Exception as e:
+                logger.error(f"Error {str(e)} occurred", exc_info=True, extra={"id": cmd_id})
+                results[ix] = e
+        if not games:
+            return results
+        curves = dict(zip(games, self._win_curves(list(games.values()))))
+
+        plots = {}
+        for ix, (raw_game, args, cmd_id) in enumerate(bets):
+            if results[ix] is not None:
+                continue
+            try:
+                args["Timestamp"] = self._check_bet_time(raw_game, args["Timestamp"])
+                minute = self._bet_time(raw_game, args["Timestamp"])
+                team = self._team_prediction(raw_game, args)
+                if team is None:
+                    raise ValueError("Bet is on neither a player nor a team in this match")
+                odds = Odds(self._probability_transform(float(curves[raw_game["match_id"]][minute]), args["Outcome"], team))
+                if plot:
+                    if raw_game["match_id"] not in plots:
+                        plots[raw_game["match_id"]] = self._process_plot_stats(games[raw_game["match_id"]])
+                    gold, xp, winner = plots[raw_game["match_id"]]
+                    plot_game(winner, xp, gold, minute, cmd_id)
+                results[ix] = (odds, self._calculate_payout(raw_game, args["Outcome"], team, odds, args["Value"]))
+            except (BetTimeException, Exception) as e:
+                logger.error(f"Error {str(e)} occurred", exc_info=True, extra={"id": cmd_id})
+                results[ix] = e
+        return results
+
     def __call__(self, raw_game: Dict, args: Dict, cmd_id: str) -> Tuple[Odds, Decimal]:
-        try:
-            X, team, processed, minute = self._get_game_info(raw_game, args, cmd_id)
-            gold, xp, winner = self._process_plot_stats(processed)
-            plot_game(winner, xp, gold, minute, cmd_id)
-            odds = self.calculate_odds(X, args["Outcome"], team)
-            payout = self._calculate_payout(raw_game, args["Outcome"], team, odds, args["Value"])
-        except (LobbyTypeException, BetTimeException, Exception) as e:
-            logger.error(f"Error {str(e)} occurred", exc_info=True, extra={"id": cmd_id})
-            raise
-        return odds, payout
+        # Errors are logged by `price_batch`
+        result = self.price_batch([(raw_game, args, cmd_id)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
 
 if __name__=="__main__":
     match_id = object()
     args = {...}
     aws = boto3.resource("s3")
-    client = SyncDotaClient(os.environ["OD_API_KEY"])
+    client = SyncDotaClient(api_keys())
     raw_game = client.parse_match_get_data(match_id, 0)
     pricing = PricingModel(aws)
     odds, payout = pricing(raw_game, args, 1)
@@ -0,0 +1,172 @@
+import asyncio
+from concurrent.futures import Executor
+from decimal import Decimal
+import disnake
+import logging
+import multiprocessing
+from typing import Dict, List, Tuple
+
+from TestBot.database.dynamo import DynamoHandler
+from TestBot.pricing import PricingModel, Odds
+from TestBot.exceptions import LobbyTypeException, BetTimeException
+from TestBot.embeds import winning_bet, losing_bet, bet_time_exception_embed
+
+# Seconds to wait for other bets on the same match before settling the group
+SETTLE_WINDOW = 2
+
+def bet_kind(args: Dict) -> str:
+    if "TeamID" in args.keys():
+        return "team"
+    elif "Username" in args.keys():
+        return "user"
+    return "member"
+
+def bet_history(args: Dict, c_id: str, match_id: int, odds: Odds, delta: Decimal, init_balance: Decimal) -> Dict:
+    bet_data = {
+        "UserID": args["UserID"],
+        "BetID": c_id,  # Unique identifier for the bet
+        "MatchID": match_id,
+        "Timestamp": args["Timestamp"],
+        "Outcome": args["Outcome"],
+        "Value": args["Value"],
+        "Odds": str(odds),
+        "BalanceDelta": delta,
+        "NewBalance": init_balance + delta,
+        "GuildID": args["GuildID"]
+    }
+    kind = bet_kind(args)
+    if kind == "team":
+        bet_data["Team"] = args["Team"]
+    elif kind == "user":
+        bet_data["BeteeUsername"] = args["Username"]
+    else:
+        bet_data["BeteeID"] = args["BeteeID"]
+    return bet_data
+
+def pricing_failure(e: Exception) -> Tuple[int, str, disnake.Embed]:
+    # Maps an exception raised while pricing a bet to its log level, log message and user embed
+    if isinstance(e, LobbyTypeException):
+        embed = disnake.Embed(title = "Lobby Error", description=f"Incorrect lobby type being bet on. Bet Refunded.")
+        return logging.WARNING, f"`LobbyTypeException` exception {str(e)} raised while calculating odds and payout", embed
+    if isinstance(e, BetTimeException):
+        return logging.WARNING, f"`BetTimeException` exception {str(e)} raised while calculating odds and payout", bet_time_exception_embed(e)
+    embed = disnake.Embed(title = "Bet Error", description="Error executing the bet. Bet refunded.")
+    return logging.WARNING, f"General exception {str(e)} raised while executing bet", embed
+
+class PendingBet:
+    def __init__(self, args: Dict, c_id: str, init_balance: Decimal, future: asyncio.Future):
+        self.args = args
+        self.c_id = c_id
+        self.init_balance = init_balance
+        self.future = future
+
+class SettlementBatcher:
+    """Groups every open bet on the same `match_id` and settles them together.
+
+    The first bet to reach settlement for a match opens a group; bets arriving within `window` seconds
+    join it. The group is priced with one `PricingModel.price_group` call, and all balance credits
+    (payouts and refunds), `InPlay` deletions and `BetHistory` rows are written with `DynamoHandler.settle_bets`,
+    which credits a bet only if its `InPlay` item still exists, so a bet resumed after a restart is settled once.
+    """
+    def __init__(self, db: DynamoHandler, pricing_model: PricingModel, cpu_executor: Executor, io_executor: Executor,
+                 output_queue: multiprocessing.Queue, log: logging.Logger, window: float = SETTLE_WINDOW):
+        self.db = db
+        self.pricing_model = pricing_model
+        self.cpu_executor = cpu_executor
+        self.io_executor = io_executor
+        self.output_queue = output_queue
+        self.log = log
+        self.window = window
+        self.groups: Dict[int, List[PendingBet]] = {}
+        self._tasks = set()
+
+    async def settle(self, match_id: int, data: Dict, args: Dict, c_id: str, init_balance: Decimal) -> None:
+        # Returns once the group containing this bet has been settled
+        loop = asyncio.get_running_loop()
+        bet = PendingBet(args, c_id, init_balance, loop.create_future())
+        if match_id not in self.groups:
+            self.groups[match_id] = []
+            task = asyncio.create_task(self._flush_later(match_id, data))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self.groups[match_id].append(bet)
+        await bet.future
+
+    async def _flush_later(self, match_id: int, data: Dict) -> None:
+        await asyncio.sleep(self.window)
+        bets = self.groups.pop(match_id)
+        try:
+            await self._flush(match_id, data, bets)
+        except Exception as e:
+            for bet in bets:
+                if not bet.future.done():
+                    bet.future.set_exception(e)
+        else:
+            for bet in bets:
+                bet.future.set_result(None)
+
+    async def _price(self, data: Dict, bets: List[PendingBet]) -> List:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.cpu_executor, self.pricing_model.price_group, data, [(bet.args, bet.c_id) for bet in bets])
+        except Exception as e:
+            # Failures that apply to the whole match, e.g. `LobbyTypeException`
+            return [e] * len(bets)
+
+    async def _flush(self, match_id: int, data: Dict, bets: List[PendingBet]) -> None:
+        results = await self._price(data, bets)
+
+        entries, history, outputs = [], [], []
+        for bet, result in zip(bets, results):
+            args, c_id = bet.args, bet.c_id
+            if isinstance(result, Exception):
+                # Refund the stake
+                level, msg, embed = pricing_failure(result)
+                self.log.log(level, msg, extra={"id":c_id})
+                outputs.append((c_id, args, embed))
+                entries.append((c_id, args["UserID"], args["Value"]))
+                continue
+
+            # Process bet outcomes based on payouts
+            odds, payout = result
+            if payout > 0:
+                embed = winning_bet(args, odds, payout, c_id)
+                entries.append((c_id, args["UserID"], payout))
+                delta = payout
+            else:
+                embed = losing_bet(args, odds, payout, c_id)
+                entries.append((c_id, args["UserID"], Decimal(0)))
+                delta = -1*args["Value"]
+            outputs.append((c_id, args, embed))
+            history.append(bet_history(args, c_id, match_id, odds, delta, bet.init_balance))
+
+        self.log.log(logging.INFO, f"Settling {len(bets)} bets on match {match_id}.", extra={"id":"settlement"})
+        loop = asyncio.get_running_loop()
+        try:
+            settled = await loop.run_in_executor(self.io_executor, self.db.settle_bets, entries, history, str(match_id))
+        except Exception:
+            self.log.log(logging.CRITICAL, f"Failed to write settlement of match {match_id} to DynamoDB. Bets: {entries}", extra={"id":"settlement"})
+            await self._refund(match_id, bets)
+            raise
+        if len(settled) < len(entries):
+            self.log.log(logging.INFO, f"{len(entries) - len(settled)} bets on match {match_id} were already settled.", extra={"id":"settlement"})
+        # Users only hear about an outcome once it is written; bets settled before a restart were already announced
+        for c_id, args, embed in outputs:
+            if c_id in settled:
+                self.output_queue.put((args, embed))
+
+    async def _refund(self, match_id: int, bets: List[PendingBet]) -> None:
+        # Refunds the stakes of a group whose settlement failed; `settle_bets` skips any bet already settled.
+        # If the refund fails too the `InPlay` items remain and the bets are refunded when the bot restarts.
+        loop = asyncio.get_running_loop()
+        entries = [(bet.c_id, bet.args["UserID"], bet.args["Value"]) for bet in bets]
+        try:
+            refunded = await loop.run_in_executor(self.io_executor, self.db.settle_bets, entries, [], str(match_id))
+            description = "The bet could not be settled. Bet refunded."
+        except Exception:
+            self.log.log(logging.CRITICAL, f"Failed to refund bets on match {match_id}: {entries}", extra={"id":"settlement"})
+            refunded = [bet.c_id for bet in bets]
+            description = "The bet could not be settled. It will be refunded when the bot restarts."
+        for bet in bets:
+            if bet.c_id in refunded:
+                self.output_queue.put((bet.args, disnake.Embed(title = "Settlement Error", description=description)))
@@ -0,0 +1,48 @@
+import bisect
+import hashlib
+import multiprocessing
+from typing import Dict, List
+
+# Virtual nodes per worker; smooths the distribution of keys across a small number of workers
+REPLICAS = 100
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+def shard_key(args: Dict) -> str:
+    # Every bet on the same target (Steam account or team) maps to the same key. `BeteeSteamID` is only
+    # resolved inside the worker, so member bets use the discord id of the betee; this keeps the key stable
+    # over the whole life of the bet.
+    if "TeamID" in args.keys():
+        return f"team:{args['TeamID']}"
+    if "Username" in args.keys():
+        return f"user:{args['GuildID']}:{args['Username'].lower()}"
+    return f"member:{args['BeteeID']}"
+
+class HashRing:
+    """Consistent hash ring mapping keys to one of `n_shards` shards.
+
+    Adding or removing a shard only moves the keys that hashed to it, which keeps the
+    watchers and caches of every other worker intact.
+    """
+    def __init__(self, n_shards: int, replicas: int = REPLICAS):
+        self.n_shards = n_shards
+        points = sorted((_hash(f"{shard}:{i}"), shard) for shard in range(n_shards) for i in range(replicas))
+        self._hashes = [p[0] for p in points]
+        self._shards = [p[1] for p in points]
+
+    def shard(self, key: str) -> int:
+        ix = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[ix]
+
+class ShardedQueue:
+    """Routes each bet to the input queue of the worker that owns its target.
+
+    Exposes the `put` of a single `multiprocessing.Queue`, so producers do not need to know about sharding.
+    """
+    def __init__(self, queues: List[multiprocessing.Queue]):
+        self.queues = queues
+        self.ring = HashRing(len(queues))
+
+    def put(self, args: Dict, block: bool = True, timeout: float = None) -> None:
+        self.queues[self.ring.shard(shard_key(args))].put(args, block, timeout)
@@ -0,0 +1,45 @@
+import random
+import unittest
+
+import numpy as np
+
+from TestBot.features import FeatureBuilder, draft_view, stats_view
+
+def parsed_game(rng: random.Random, n_minutes: int) -> dict:
+    # The shape of `GameParser.parse` output: players keyed by slot with team, lane and per-minute series
+    players = {}
+    for slot in range(10):
+        players[slot] = {"team": 1 if slot < 5 else -1, "lane": rng.randint(1, 4), "hero_id": rng.randint(1, 130),
+                         "xp_t": [rng.randint(0, 30000) for _ in range(n_minutes)],
+                         "lh_t": [rng.randint(0, 400) for _ in range(n_minutes)],
+                         "gold_t": [rng.randint(0, 30000) for _ in range(n_minutes)]}
+    return {"patch": 53, "times": [60 * t for t in range(n_minutes)], "players": players}
+
+def old_row(parsed: dict, t: int):
+    # Draft and stats inputs as they were built before the `features` layout: one row of
+    # patch, time, then heroes, xp, last hits and gold of radiant and then dire, sliced per model
+    players = parsed["players"]
+    radiant = sorted([players[key] for key in players if players[key]["team"] == 1], key=lambda x: x["lane"])
+    dire = sorted([players[key] for key in players if players[key]["team"] == -1], key=lambda x: x["lane"])
+    team = lambda side: [p["hero_id"] for p in side] + [p["xp_t"][t] for p in side] + [p["lh_t"][t] for p in side] + [p["gold_t"][t] for p in side]
+    X = np.array([[parsed["patch"], parsed["times"][t]] + team(radiant) + team(dire)])
+    draft = np.concatenate([X[:, 1:2], X[:, 2:7], X[:, 22:27]], axis=1)
+    stats = np.concatenate([X[:, 1:2], X[:, 7:22], X[:, 27:]], axis=1)
+    return draft.astype(np.float32), stats.astype(np.float32)
+
+class FeatureBuilderTest(unittest.TestCase):
+    def test_rows_match_old_draft_and_stats_layout(self):
+        rng = random.Random(0)
+        games = [parsed_game(rng, n) for n in (25, 40)]
+        X = FeatureBuilder(rows=8).build_many(games)
+        self.assertEqual(len(X), 65)
+        row = 0
+        for game in games:
+            for t in range(len(game["times"])):
+                draft, stats = old_row(game, t)
+                np.testing.assert_array_equal(draft_view(X)[row:row + 1], draft)
+                np.testing.assert_array_equal(stats_view(X)[row:row + 1], stats)
+                row += 1
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+
+from TestBot.opendota.watcher import AsyncWatcherRegistry
+
+class FixedScheduler:
+    def next_delay(self, last_match, placed_at, now, kind=None):
+        return 0.01
+
+class AsyncWatcherRegistryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.latest = {"match_id": 100, "start_time": 0, "duration": 0}
+
+        async def fetch_latest(target_id):
+            return dict(self.latest)
+
+        self.registry = AsyncWatcherRegistry({"player": fetch_latest}, scheduler=FixedScheduler())
+
+    async def test_subscriber_joining_after_publish_waits_for_next_match(self):
+        a = await self.registry.subscribe("player", 1, "a")
+        b = await self.registry.subscribe("player", 1, "b")
+        self.latest = {"match_id": 101, "start_time": 0, "duration": 0}
+        self.assertEqual(await asyncio.wait_for(a.future, 1), 101)
+        self.assertEqual(await asyncio.wait_for(b.future, 1), 101)
+
+        # `b` keeps the watcher alive; a bet placed now must not resolve to the finished match 101
+        c = await self.registry.subscribe("player", 1, "c")
+        self.assertEqual(c.baseline, 101)
+        await asyncio.sleep(0.05)
+        self.assertFalse(c.future.done())
+
+        self.latest = {"match_id": 102, "start_time": 0, "duration": 0}
+        self.assertEqual(await asyncio.wait_for(c.future, 1), 102)
+        for sub in (a, b, c):
+            self.registry.unsubscribe(sub)
+
+    async def test_subscriber_placed_after_unpolled_match_ended_waits_for_next_match(self):
+        a = await self.registry.subscribe("player", 1, "a", placed_at=1000)
+        # Placed after match 101 ended, but before the watcher polled it
+        c = await self.registry.subscribe("player", 1, "c", placed_at=3000)
+        self.assertEqual(c.baseline, 100)
+        self.latest = {"match_id": 101, "start_time": 1500, "duration": 1000}
+        self.assertEqual(await asyncio.wait_for(a.future, 1), 101)
+        await asyncio.sleep(0.05)
+        self.assertFalse(c.future.done())
+        self.assertEqual(c.baseline, 101)
+
+        self.latest = {"match_id": 102, "start_time": 3500, "duration": 1000}
+        self.assertEqual(await asyncio.wait_for(c.future, 1), 102)
+        for sub in (a, c):
+            self.registry.unsubscribe(sub)
+
+    async def test_resumed_subscriber_is_notified_of_missed_match(self):
+        sub = await self.registry.subscribe("player", 1, "a", baseline=99)
+        self.assertEqual(await asyncio.wait_for(sub.future, 1), 100)
+        self.registry.unsubscribe(sub)
+
+if __name__=="__main__":
+    unittest.main()
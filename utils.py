@@ -3,45 +3,168 @@ import disnake
 import logging
 import os 
 import multiprocessing
+import queue
+import threading
 import  time
+from typing import Dict, Tuple
 
 ROOT = os.environ["ROOT"]
 
+# Records per batch shipped by `BatchQueueHandler`, and the longest a record waits in its buffer
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 0.5
+# Batches written per flush by `stream_bet_logs`
+LOG_DRAIN_LIMIT = 64
+
+async def send_output(bot, args: Dict, embed: disnake.Embed) -> None:
+    channel, user = bot.get_channel(args["ChannelID"]), args["UserID"]
+    if (embed.title == "Losing Bet") or (embed.title == "Winning Bet"):
+        file = disnake.File(f"{ROOT}/data/plots/game{args['cmd_id']}.png", filename=f"game{args['cmd_id']}.png")
+        await channel.send(f"<@{user}>", embed=embed, file=file)
+    else:
+        await channel.send(f"<@{user}>", embed=embed)
+
+async def drain_channel(bot, channel_id: int, channel_queue: asyncio.Queue, channels: Dict[int, asyncio.Queue], logger: logging.Logger) -> None:
+    # Sends one channel's outputs in order; exits (and forgets the channel) once its queue is empty
+    while not channel_queue.empty():
+        args, embed = channel_queue.get_nowait()
+        try:
+            await send_output(bot, args, embed)
+        except Exception as e:
+            logger.error(f"Failed to send output to channel {channel_id}: {str(e)}", exc_info=True, extra={"id":args.get("cmd_id", "NULL")})
+    del channels[channel_id]
+
 async def stream_outputs(bot, output_queue: multiprocessing.Queue):
-    while True:
-        if output_queue.empty():
-            await asyncio.sleep(120)
-        else:
-            args, embed = output_queue.get()
-            channel, user = bot.get_channel(args["ChannelID"]), args["UserID"]
-            if (embed.title == "Losing Bet") or (embed.title == "Winning Bet"):
-                file = disnake.File(f"{ROOT}/data/plots/game{args['cmd_id']}.png", filename=f"game{args['cmd_id']}.png")
-                await channel.send(f"<@{user}>", embed=embed, file=file)
-            else:
-                await channel.send(f"<@{user}>", embed=embed)
+    # A feeder thread blocks on `output_queue` and wakes the event loop as soon as a result arrives.
+    # Results are sent concurrently across channels and in arrival order within each channel.
+    logger = get_logger(dir=f"{ROOT}/data/logs", filename="Output.log", level=logging.INFO)
+    loop = asyncio.get_running_loop()
+    channels: Dict[int, asyncio.Queue] = {}
+    tasks = set()
+
+    def route(item: Tuple[Dict, disnake.Embed]) -> None:
+        channel_id = item[0]["ChannelID"]
+        channel_queue = channels.get(channel_id)
+        if channel_queue is None:
+            channel_queue = channels[channel_id] = asyncio.Queue()
+            task = loop.create_task(drain_channel(bot, channel_id, channel_queue, channels, logger))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        channel_queue.put_nowait(item)
+
+    def feed() -> None:
+        while True:
+            item = output_queue.get()
+            try:
+                loop.call_soon_threadsafe(route, item)
+            except RuntimeError:
+                # The event loop has closed
+                return
+
+    # A daemon thread rather than an executor thread, which `asyncio.run` and interpreter exit would wait on forever
+    threading.Thread(target=feed, name="outputs", daemon=True).start()
+    # Runs until cancelled with the rest of the bot
+    await loop.create_future()
 
 def stream_bet_logs(log_queue: multiprocessing.Queue):
+    # Consumer side of `BatchQueueHandler`; blocks until a batch arrives, drains whatever else is queued
+    # and writes it to `Betting.log` in a single write and flush
     logger = get_logger(dir=f"{ROOT}/data/logs", filename="Betting.log", level=logging.DEBUG)
+    handlers = [h for h in logger.handlers if isinstance(h, logging.FileHandler)]
     while True:
-        if log_queue.empty():
-            time.sleep(60)
-        else:
-            log = log_queue.get()
-            if log.level == logging.DEBUG:
-                logger.debug(log.msg, extra={"id":log.id})
-                continue
-            if log.level == logging.INFO:
-                logger.info(log.msg, extra={"id":log.id})
-                continue
-            if log.level == logging.WARNING:
-                logger.warning(log.msg, extra={"id":log.id})
-                continue
-            if log.level == logging.ERROR:
-                logger.error(log.msg, extra={"id":log.id})
-                continue
-            if log.level == logging.CRITICAL:
-                logger.critical(log.msg, extra={"id":log.id})
-                continue
+        batches = [log_queue.get()]
+        while len(batches) < LOG_DRAIN_LIMIT:
+            try:
+                batches.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        records = [_to_record(logger.name, item) for batch in batches for item in batch]
+        for handler in handlers:
+            lines = "".join(handler.format(record) + handler.terminator for record in records if record.levelno >= handler.level)
+            with handler.lock:
+                handler.stream.write(lines)
+                handler.flush()
+
+def _to_record(name: str, item: Tuple[float, int, str, str]) -> logging.LogRecord:
+    created, level, id, msg = item
+    record = logging.LogRecord(name, level, "", 0, msg, None, None)
+    record.created, record.msecs, record.id = created, (created - int(created)) * 1000, id
+    return record
+
+class BatchQueueHandler(logging.Handler):
+    """Ships log records to `stream_bet_logs` over a `multiprocessing.Queue` in batches.
+
+    Each record is reduced to a `(created, levelno, id, message)` tuple and buffered. The buffer is put on the
+    queue once it holds `capacity` records, when a record of `flush_level` or above arrives, and every
+    `interval` seconds from a background thread. Puts never block; a batch is dropped if the queue is full.
+    """
+    def __init__(self, log_queue: multiprocessing.Queue, capacity: int = LOG_BATCH_SIZE, interval: float = LOG_FLUSH_INTERVAL,
+                 flush_level: int = logging.ERROR):
+        super().__init__()
+        self.log_queue = log_queue
+        self.capacity = capacity
+        self.flush_level = flush_level
+        self.buffer = []
+        self.dropped = 0
+        self._interval = interval
+        self._flusher = threading.Thread(target=self._flush_periodically, name="log-flusher", daemon=True)
+        self._flusher.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            item = (record.created, record.levelno, getattr(record, "id", "NULL"), record.getMessage())
+        except Exception:
+            self.handleError(record)
+            return
+        self.buffer.append(item)
+        if len(self.buffer) >= self.capacity or record.levelno >= self.flush_level:
+            self.flush()
+
+    def flush(self) -> None:
+        self.acquire()
+        try:
+            batch, self.buffer = self.buffer, []
+        finally:
+            self.release()
+        if not batch:
+            return
+        try:
+            self.log_queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped += len(batch)
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self._interval)
+            self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        super().close()
+
+def process_memory() -> Dict[str, float]:
+    # Resident, proportional (shared pages split between the processes using them) and private memory in MB.
+    # Linux only; empty elsewhere.
+    memory = {}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss", "Private_Clean", "Private_Dirty"):
+                    memory[name] = int(value.split()[0]) / 1024
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {"rss": memory.get("Rss", 0.0), "pss": memory.get("Pss", 0.0),
+            "private": memory.get("Private_Clean", 0.0) + memory.get("Private_Dirty", 0.0)}
+
+def get_queue_logger(log_queue: multiprocessing.Queue, name: str = "Betting") -> logging.Logger:
+    # Logger for worker processes; records are written by the `stream_bet_logs` process
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    if not any(isinstance(h, BatchQueueHandler) for h in logger.handlers):
+        logger.addHandler(BatchQueueHandler(log_queue))
+    return logger
 
 def get_logger(dir: str, filename: str, level=logging.DEBUG) -> logging.Logger:
     # Construct full path
@@ -65,22 +188,3 @@ def get_logger(dir: str, filename: str, level=logging.DEBUG) -> logging.Logger:
         logger.addHandler(file_handler)
 
     return logger
-
-class LogMessage:
-    def __init__(self, level: int, msg: str, id: str):
-        self._level = level
-        self._msg = msg
-        self._id = id 
-    
-    @property
-    def level(self):
-        return self._level
-
-    @property
-    def msg(self):
-        return self._msg
-    
-    @property
-    def id(self):
-        return self._id
-